@@ -44,8 +44,8 @@
 """
 
 import sys
-import time
 import subprocess
+import numpy as np
 
 from PyQt5 import QtCore, QtWidgets, QtGui
 from PyQt5.QtWidgets import QMainWindow, QLabel, QApplication, QGridLayout, QWidget, QMessageBox, QProgressBar
@@ -61,11 +61,37 @@ SOBRE_DATA = "02/08/2020"
 SOBRE_LINK_VIDEO = "[url]"
 
 
+def get_pixmap(imagem: Imagem, largura: int, altura: int, regiao: tuple = None) -> QtGui.QPixmap:
+    """
+    Pixmap de ate largura x altura com a regiao visivel (x, y, altura, largura) da imagem, ou a
+    imagem inteira. Os pixels vem do nivel da piramide mais proximo do tamanho exibido, entao o
+    custo nao depende do tamanho da imagem.
+    """
+    if regiao is None:
+        regiao = (0, 0, imagem.get_altura(), imagem.get_largura())
+    if regiao[2] <= 0 or regiao[3] <= 0:
+        # Filtros que cortam a borda podem deixar a imagem sem pixels
+        return QtGui.QPixmap()
+    escala = min(largura / regiao[3], altura / regiao[2])
+    pixels = imagem.get_visualizacao(regiao[0], regiao[1], regiao[2], regiao[3], escala)
+
+    if pixels.ndim > 2 and pixels.shape[2] >= 3:
+        pixels = np.ascontiguousarray(pixels[:, :, :3])
+        formato = QtGui.QImage.Format_RGB888
+    else:
+        pixels = np.ascontiguousarray(pixels.reshape(pixels.shape[:2] + (-1,))[:, :, 0])
+        formato = QtGui.QImage.Format_Grayscale8
+    qimage = QtGui.QImage(pixels.data, pixels.shape[1], pixels.shape[0], pixels.strides[0], formato)
+
+    # A QImage usa o buffer do array sem copia: copiar antes que ele seja liberado
+    pixmap = QtGui.QPixmap.fromImage(qimage.copy())
+    return pixmap.scaled(largura, altura, QtCore.Qt.KeepAspectRatio)
+
+
 class MyWindow(QMainWindow):
     # Constantes
     LARGURA = 640
     ALTURA = 480
-    CAMINHO_TEMP = '.temp'
 
     def __init__(self):
         super(MyWindow, self).__init__()
@@ -235,8 +261,8 @@ class MyWindow(QMainWindow):
     def open_file(self):
         file_name, _ = QtWidgets.QFileDialog.getOpenFileName(self, caption="Abrir Imagem",
                                                             directory=QtCore.QDir.currentPath(),
-                                                            filter='Imagens(*.ppm; *.pgm; *.pbm)',
-                                                            initialFilter='Imagens(*.ppm; *.pgm; *.pbm)')
+                                                            filter='Imagens(*.ppm; *.pgm; *.pbm; *.pam)',
+                                                            initialFilter='Imagens(*.ppm; *.pgm; *.pbm; *.pam)')
         if file_name != '':
             print('Abrindo imagem...')
             self.texto_progresso.setText('Abrindo imagem...')
@@ -259,8 +285,7 @@ class MyWindow(QMainWindow):
             print('Abrir imagem -> 80%')
 
             self.barra_progresso.setValue(80)
-            pixmap = QtGui.QPixmap(file_name)
-            pixmap = pixmap.scaled(250, 250, QtCore.Qt.KeepAspectRatio)
+            pixmap = get_pixmap(self.imagem_original, 250, 250)
             self.imagem_1.setPixmap(pixmap)
             self.imagem_2.setPixmap(pixmap)
             print('Abrir imagem -> 100%')
@@ -306,8 +331,7 @@ class MyWindow(QMainWindow):
         print('Resetar imagem -> 80%')
 
         self.barra_progresso.setValue(80)
-        pixmap = QtGui.QPixmap(self.imagem_alterada.get_caminho())
-        pixmap = pixmap.scaled(250, 250, QtCore.Qt.KeepAspectRatio)
+        pixmap = get_pixmap(self.imagem_alterada, 250, 250)
         self.imagem_2.setPixmap(pixmap)
         print('Resetar imagem -> 100%')
 
@@ -325,13 +349,10 @@ class MyWindow(QMainWindow):
         print('Processamento -> 40%')
 
         self.barra_progresso.setValue(40)
-        self.imagem_alterada.salvar(MyWindow.CAMINHO_TEMP)
-        time.sleep(.1)
+        pixmap = get_pixmap(self.imagem_alterada, 250, 250)
         print('Processamento -> 80%')
 
         self.barra_progresso.setValue(80)
-        pixmap = QtGui.QPixmap(self.imagem_alterada.get_caminho())
-        pixmap = pixmap.scaled(250, 250, QtCore.Qt.KeepAspectRatio)
         self.imagem_2.setPixmap(pixmap)
         print('Processamento -> 100%')
 
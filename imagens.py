@@ -4,16 +4,76 @@
 
     Contém as definições de imagem.
     São elas:
-    - PBM
-    - PGM
-    - PPM
+    - PBM (P1 e P4)
+    - PGM (P2 e P5)
+    - PPM (P3 e P6)
+    - PAM (P7)
 """
 
+import bz2
+import functools
+import gzip
+import lzma
+import mmap
+import multiprocessing
 import numpy as np
+import os
 import re
+import shutil
+import tempfile
+import warnings
+import weakref
+from collections import OrderedDict
+
+
+# Tipos plain-text e seus equivalentes binarios (raw)
+TIPOS_BRUTOS = {'P1': 'P4', 'P2': 'P5', 'P3': 'P6'}
+TIPOS_PLAIN = {'P4': 'P1', 'P5': 'P2', 'P6': 'P3'}
+
+# Modos de carregamento: em memoria, mmap somente leitura e mmap copy-on-write
+MODOS_MMAP = (None, 'r', 'c')
+
+# Tamanho do buffer de escrita dos arquivos
+TAMANHO_BUFFER = 1 << 20
+
+# Compressoes aceitas: extensao, assinatura (magic bytes) e modulo que le e escreve o formato
+COMPRESSOES = (('.gz', b'\x1f\x8b', gzip),
+               ('.bz2', b'BZh', bz2),
+               ('.xz', b'\xfd7zXZ\x00', lzma))
+
+# Limite de caracteres por linha nos formatos plain-text
+LIMITE_LINHA = 70
+
+# Quantidade de amostras formatadas por vez na escrita plain-text
+AMOSTRAS_POR_BLOCO = 1 << 20
+
+# Pesos (R, G, B) de cada luminancia na conversao para cinza; None e a media simples
+LUMINANCIAS = {
+    'media': None,
+    'bt601': (0.299, 0.587, 0.114),
+    'bt709': (0.2126, 0.7152, 0.0722),
+}
+
+# Comentario nos pixels plain-text: do '#' ate o fim da linha
+RE_COMENTARIO = re.compile(rb'#([^\r\n]*)')
+
+# Bytes considerados espaco entre as amostras plain-text
+ESPACOS = np.zeros(256, dtype=bool)
+ESPACOS[list(b' \t\r\n\v\f')] = True
+
+# Leitura plain-text paralela: tamanho minimo de cada bloco e blocos por processo
+TAMANHO_BLOCO_PARALELO = 1 << 22
+BLOCOS_POR_PROCESSO = 4
+
+# Imagens em tiles: lado de cada tile e bytes de tiles decodificados mantidos em memoria
+TAMANHO_TILE = 256
+ORCAMENTO_TILES = 64 << 20
 
 
 class Cor:
+    # Sem __dict__: get_pixel cria um Cor por chamada
+    __slots__ = ('__r', '__g', '__b')
+
     def __init__(self, r: int, g: int, b: int):
         self.__r = r
         self.__g = g
@@ -33,15 +93,50 @@ class Cor:
 
 
 class FormatoImagem:
-    def __init__(self, imagem: 'Imagem'):
+    """
+        Clones compartilham o buffer de pixels (copy-on-write): enquanto compartilhado, os pixels
+        sao entregues somente leitura e a primeira alteracao (set_pixel ou get_pixels com
+        escrita=True) faz a copia. Trocar os pixels inteiros (set_pixels) nao copia nada.
+    """
+    def __init__(self, imagem: 'Imagem', bruto: bool = False):
         self.__imagem = imagem
+        self.__bruto = bruto
+        self.__compartilhado = False
 
     def get_imagem(self) -> 'Imagem':
         return self.__imagem
 
+    def get_bruto(self) -> bool:
+        return self.__bruto
+
+    def get_compartilhado(self) -> bool:
+        """
+        Indica se o buffer de pixels pode estar em uso por um clone.
+        """
+        return self.__compartilhado
+
+    def set_compartilhado(self, compartilhado: bool):
+        self.__compartilhado = compartilhado
+
+    def proteger(self, pixels):
+        """
+        Visao somente leitura dos pixels, se o buffer for compartilhado.
+        """
+        if pixels is None or not self.__compartilhado:
+            return pixels
+        visao = pixels.view()
+        visao.flags.writeable = False
+        return visao
+
     def get_binario(self) -> bool:
         pass
 
+    def get_canais(self) -> int:
+        return 1
+
+    def get_alfa(self) -> bool:
+        return False
+
     def get_maxval(self) -> int:
         pass
 
@@ -57,33 +152,79 @@ class FormatoImagem:
     def set_pixel(self, x, y, cor: Cor or int):
         pass
 
-    def get_pixels(self):
+    def get_pixels(self, escrita: bool = False):
+        """
+        :param escrita: se os pixels serao alterados no lugar; copia o buffer se compartilhado
+        """
         pass
 
     def set_pixels(self, pixels):
         pass
 
+    def get_matriz(self, escrita: bool = False):
+        pass
+
+    def set_matriz(self, matriz):
+        self.set_pixels(matriz)
+
+    def get_pixels_empacotados(self):
+        pass
+
+    def set_pixels_empacotados(self, bits):
+        pass
+
+    def read_cabecalho(self, arquivo):
+        """
+        Le o que vem depois do tipo no cabecalho: dimensoes e maxval.
+        """
+        imagem = self.get_imagem()
+        imagem.set_largura(int(imagem.pre_processar_token(arquivo)))
+        imagem.set_altura(int(imagem.pre_processar_token(arquivo)))
+        self.read_maxval(arquivo)
+
     def read_maxval(self, arquivo):
         pass
 
     def read_pixels(self, arquivo):
         pass
 
+    def write_cabecalho(self, arquivo):
+        imagem = self.get_imagem()
+        arquivo.write((str(imagem.get_largura()) + ' ' + str(imagem.get_altura()) + '\n').encode('ascii'))
+        self.write_maxval(arquivo)
+
     def write_maxval(self, arquivo):
         pass
 
     def write_pixels(self, arquivo):
         pass
 
+    def get_bytes_linha(self) -> int:
+        pass
+
+    def read_linhas(self, arquivo, quantidade: int, pendentes: list):
+        """
+        :param pendentes: amostras plain-text ja lidas e ainda nao usadas, mantidas entre chamadas
+        """
+        pass
+
+    def write_linhas(self, arquivo, linhas):
+        pass
+
     def clonar(self, imagem: 'Imagem') -> 'FormatoImagem':
         pass
 
 
 class FormatoPBM(FormatoImagem):
-    def __init__(self, imagem):
-        FormatoImagem.__init__(self, imagem)
+    """
+        Os pixels ficam empacotados, 8 por byte, uma linha da imagem por linha da matriz
+        (o mesmo layout do P4). Bits de sobra no fim de cada linha sao mantidos em 0.
+        get_matriz e get_pixels retornam copias desempacotadas.
+    """
+    def __init__(self, imagem, bruto: bool = False):
+        FormatoImagem.__init__(self, imagem, bruto)
 
-        self.__pixels = None
+        self.__bits = None
 
     def get_binario(self) -> bool:
         return True
@@ -98,11 +239,10 @@ class FormatoPBM(FormatoImagem):
         return '.pbm'
 
     def get_pixel(self, x, y) -> Cor:
-        if self.__pixels is None:
+        if self.__bits is None:
             raise Exception()
 
-        indice = (x * self.get_imagem().get_largura()) + y
-        if self.__pixels[indice] == 0:
+        if (self.__bits[x, y >> 3] >> (7 - (y & 7))) & 1 == 0:
             cor = 0
         else:
             cor = 255
@@ -110,45 +250,115 @@ class FormatoPBM(FormatoImagem):
         return Cor(cor, cor, cor)
 
     def set_pixel(self, x, y, cor: Cor or int):
-        if self.__pixels is None:
+        if self.__bits is None:
             raise Exception()
         if type(cor) != int:
             raise Exception()
 
-        indice = (x * self.get_imagem().get_largura()) + y
-        self.__pixels[indice] = cor % 2
+        self.__separar()
+        bit = 1 << (7 - (y & 7))
+        if cor % 2 == 0:
+            self.__bits[x, y >> 3] &= ~bit & 0xFF
+        else:
+            self.__bits[x, y >> 3] |= bit
 
-    def get_pixels(self):
-        return self.__pixels
+    def get_pixels(self, escrita: bool = False):
+        """
+        Retorna uma copia desempacotada dos pixels; alteracoes nela nao afetam a imagem.
+        """
+        if self.__bits is None:
+            return None
+        return self.get_matriz().ravel()
+
+    def get_matriz(self, escrita: bool = False):
+        if self.__bits is None:
+            return None
+        return np.unpackbits(self.__bits, axis=1, count=self.get_imagem().get_largura())
 
     def set_pixels(self, pixels):
-        self.__pixels = pixels
+        pixels = Imagem.saturar(pixels, 1)
+        pixels = np.reshape(pixels, (self.get_imagem().get_altura(), self.get_imagem().get_largura()))
+        self.__bits = np.packbits(pixels, axis=1)
+
+    def get_pixels_empacotados(self):
+        return self.proteger(self.__bits)
+
+    def set_pixels_empacotados(self, bits):
+        bits = np.reshape(bits, (self.get_imagem().get_altura(), self.get_bytes_linha()))
+        self.set_compartilhado(self.get_compartilhado() and np.may_share_memory(bits, self.__bits))
+        self.__bits = bits
+        self.__limpar_sobra()
+
+    def __separar(self):
+        if self.get_compartilhado() or not self.__bits.flags.writeable:
+            self.__bits = np.copy(self.__bits)
+            self.set_compartilhado(False)
+
+    def __limpar_sobra(self):
+        sobra = self.get_imagem().get_largura() % 8
+        if sobra != 0 and self.__bits.size > 0:
+            mascara = (0xFF << (8 - sobra)) & 0xFF
+            if np.any(self.__bits[:, -1] & (mascara ^ 0xFF)):
+                if self.get_compartilhado() or not self.__bits.flags.writeable:
+                    self.__bits = np.copy(self.__bits)
+                    self.set_compartilhado(False)
+                self.__bits[:, -1] &= mascara
 
     def read_maxval(self, arquivo):
         pass
 
     def read_pixels(self, arquivo):
-        imagem = self.get_imagem().pre_processar_resto(arquivo)
-        imagem = re.sub(r'\s', '', imagem)
-        imagem = np.asarray(list(imagem), dtype=int)
-        self.__pixels = imagem
+        if self.get_bruto():
+            # Cada linha ocupa um numero inteiro de bytes, 8 pixels por byte: ja vem empacotado
+            quantidade = self.get_imagem().get_altura() * self.get_bytes_linha()
+            self.set_pixels_empacotados(self.get_imagem().pre_processar_bruto(arquivo, quantidade, 255, False))
+            return
+
+        quantidade = self.get_imagem().get_altura() * self.get_imagem().get_largura()
+        self.set_pixels(self.get_imagem().ler_resto_bits(arquivo, quantidade))
 
     def write_maxval(self, arquivo):
         pass
 
     def write_pixels(self, arquivo):
-        bits = [str(p) + '\n' for p in self.__pixels]
-        arquivo.writelines(bits)
+        if self.get_bruto():
+            arquivo.write(np.ascontiguousarray(self.__bits).data)
+            return
+
+        self.write_linhas(arquivo, self.get_pixels())
+
+    def get_bytes_linha(self) -> int:
+        return (self.get_imagem().get_largura() + 7) // 8
+
+    def read_linhas(self, arquivo, quantidade: int, pendentes: list):
+        largura = self.get_imagem().get_largura()
+        if self.get_bruto():
+            dados = Imagem.ler_bruto(arquivo, quantidade * self.get_bytes_linha(), 255)
+            dados = np.reshape(dados, (quantidade, self.get_bytes_linha()))
+            return np.unpackbits(dados, axis=1, count=largura)
+
+        amostras = self.get_imagem().pre_processar_amostras(arquivo, quantidade * largura, pendentes, True)
+        return np.reshape(np.asarray(amostras, dtype=np.uint8), (quantidade, largura))
+
+    def write_linhas(self, arquivo, linhas):
+        if self.get_bruto():
+            bits = np.reshape(np.asarray(linhas) != 0, (-1, self.get_imagem().get_largura()))
+            arquivo.write(np.packbits(bits, axis=1).tobytes())
+            return
+
+        Imagem.escrever_plain(arquivo, linhas, 1)
 
     def clonar(self, imagem: 'Imagem'):
-        clone = FormatoPBM(imagem)
-        clone.__pixels = np.copy(self.__pixels)
+        clone = FormatoPBM(imagem, self.get_bruto())
+        clone.__bits = self.__bits
+        clone.set_compartilhado(True)
+        self.set_compartilhado(True)
         return clone
 
 
 class FormatoPGM(FormatoImagem):
-    def __init__(self, imagem):
-        FormatoImagem.__init__(self, imagem)
+    def __init__(self, imagem, bruto: bool = False):
+        FormatoImagem.__init__(self, imagem, bruto)
 
         self.__maxval = 255
         self.__pixels = None
@@ -161,6 +371,8 @@ class FormatoPGM(FormatoImagem):
 
     def set_maxval(self, maxval: int):
         self.__maxval = maxval
+        if self.__pixels is not None:
+            self.__pixels = Imagem.saturar(self.__pixels, maxval)
 
     def get_extensao(self) -> str:
         return '.pgm'
@@ -169,8 +381,7 @@ class FormatoPGM(FormatoImagem):
         if self.__pixels is None:
             raise Exception()
 
-        indice = (x * self.get_imagem().get_largura()) + y
-        cor = Imagem.get_cor_255(self.__pixels[indice], self.__maxval)
+        cor = Imagem.get_cor_255(self.__pixels[x, y], self.__maxval)
         return Cor(cor, cor, cor)
 
     def set_pixel(self, x, y, cor: Cor or int):
@@ -179,40 +390,84 @@ class FormatoPGM(FormatoImagem):
         if type(cor) != int:
             raise Exception()
 
-        indice = (x * self.get_imagem().get_largura()) + y
-        self.__pixels[indice] = cor % self.__maxval
+        self.__separar()
+        self.__pixels[x, y] = cor % self.__maxval
 
-    def get_pixels(self):
-        return self.__pixels
+    def get_pixels(self, escrita: bool = False):
+        """
+        Visao (altura * largura) dos pixels, sem copia.
+        """
+        if self.__pixels is None:
+            return None
+        return self.get_matriz(escrita).reshape(-1)
 
     def set_pixels(self, pixels):
+        pixels = Imagem.saturar(pixels, self.__maxval)
+        pixels = np.ascontiguousarray(np.reshape(pixels, (self.get_imagem().get_altura(),
+                                                          self.get_imagem().get_largura())))
+        self.set_compartilhado(self.get_compartilhado() and np.may_share_memory(pixels, self.__pixels))
         self.__pixels = pixels
 
+    def get_matriz(self, escrita: bool = False):
+        if escrita:
+            self.__separar()
+        return self.proteger(self.__pixels)
+
+    def __separar(self):
+        # Tambem copia buffers somente leitura, como os mapeados com modo_mmap='r'
+        if self.get_compartilhado() or not self.__pixels.flags.writeable:
+            self.__pixels = np.copy(self.__pixels)
+            self.set_compartilhado(False)
+
     def read_maxval(self, arquivo):
-        self.__maxval = int(self.get_imagem().pre_processar_linha(arquivo))
+        self.__maxval = int(self.get_imagem().pre_processar_token(arquivo))
 
     def read_pixels(self, arquivo):
-        imagem = self.get_imagem().pre_processar_resto(arquivo)
-        imagem = np.asarray(imagem.split(), dtype=int)
-        self.__pixels = imagem
+        forma = (self.get_imagem().get_altura(), self.get_imagem().get_largura())
+        quantidade = forma[0] * forma[1]
+        if self.get_bruto():
+            imagem = self.get_imagem().pre_processar_bruto(arquivo, quantidade, self.__maxval)
+        else:
+            imagem = self.get_imagem().ler_resto(arquivo, quantidade, self.__maxval)
+        self.__pixels = np.reshape(imagem, forma)
 
     def write_maxval(self, arquivo):
-        arquivo.write(str(self.get_maxval()) + '\n')
+        arquivo.write((str(self.get_maxval()) + '\n').encode('ascii'))
 
     def write_pixels(self, arquivo):
-        bits = [str(p) + '\n' for p in self.__pixels]
-        arquivo.writelines(bits)
+        self.write_linhas(arquivo, self.__pixels)
+
+    def get_bytes_linha(self) -> int:
+        return self.get_imagem().get_largura() * Imagem.get_dtype_bruto(self.__maxval).itemsize
+
+    def read_linhas(self, arquivo, quantidade: int, pendentes: list):
+        largura = self.get_imagem().get_largura()
+        if self.get_bruto():
+            linhas = Imagem.ler_bruto(arquivo, quantidade * largura, self.__maxval)
+        else:
+            linhas = self.get_imagem().pre_processar_amostras(arquivo, quantidade * largura, pendentes)
+            linhas = Imagem.estreitar_amostras(np.asarray(linhas, dtype=np.int64), self.__maxval)
+        return np.reshape(linhas, (quantidade, largura))
+
+    def write_linhas(self, arquivo, linhas):
+        if self.get_bruto():
+            Imagem.escrever_bruto(arquivo, linhas, self.__maxval)
+            return
+
+        Imagem.escrever_plain(arquivo, linhas, self.__maxval)
 
     def clonar(self, imagem: 'Imagem'):
-        clone = FormatoPGM(imagem)
+        clone = FormatoPGM(imagem, self.get_bruto())
         clone.__maxval = self.__maxval
-        clone.__pixels = np.copy(self.__pixels)
+        clone.__pixels = self.__pixels
+        clone.set_compartilhado(True)
+        self.set_compartilhado(True)
         return clone
 
 
 class FormatoPPM(FormatoImagem):
-    def __init__(self, imagem):
-        FormatoImagem.__init__(self, imagem)
+    def __init__(self, imagem, bruto: bool = False):
+        FormatoImagem.__init__(self, imagem, bruto)
 
         self.__maxval = 255
         self.__pixels = None
@@ -225,6 +480,11 @@ class FormatoPPM(FormatoImagem):
 
     def set_maxval(self, maxval: int):
         self.__maxval = maxval
+        if self.__pixels is not None:
+            self.__pixels = Imagem.saturar(self.__pixels, maxval)
+
+    def get_canais(self) -> int:
+        return 3
 
     def get_extensao(self) -> str:
         return '.ppm'
@@ -233,10 +493,9 @@ class FormatoPPM(FormatoImagem):
         if self.__pixels is None:
             raise Exception()
 
-        indice = (x * self.get_imagem().get_largura()) + y
-        return Cor(Imagem.get_cor_255(self.__pixels[indice][0], self.__maxval),
-                   Imagem.get_cor_255(self.__pixels[indice][1], self.__maxval),
-                   Imagem.get_cor_255(self.__pixels[indice][2], self.__maxval))
+        return Cor(Imagem.get_cor_255(self.__pixels[x, y, 0], self.__maxval),
+                   Imagem.get_cor_255(self.__pixels[x, y, 1], self.__maxval),
+                   Imagem.get_cor_255(self.__pixels[x, y, 2], self.__maxval))
 
     def set_pixel(self, x, y, cor: Cor or int):
         if self.__pixels is None:
@@ -244,37 +503,266 @@ class FormatoPPM(FormatoImagem):
         if type(cor) != Cor:
             raise Exception()
 
-        indice = (x * self.get_imagem().get_largura()) + y
-        self.__pixels[indice][0] = Imagem.get_cor_maxval(cor.get_r(), self.__maxval)
-        self.__pixels[indice][1] = Imagem.get_cor_maxval(cor.get_g(), self.__maxval)
-        self.__pixels[indice][2] = Imagem.get_cor_maxval(cor.get_b(), self.__maxval)
+        self.__separar()
+        self.__pixels[x, y, 0] = Imagem.get_cor_maxval(cor.get_r(), self.__maxval)
+        self.__pixels[x, y, 1] = Imagem.get_cor_maxval(cor.get_g(), self.__maxval)
+        self.__pixels[x, y, 2] = Imagem.get_cor_maxval(cor.get_b(), self.__maxval)
 
-    def get_pixels(self):
-        return self.__pixels
+    def get_pixels(self, escrita: bool = False):
+        """
+        Visao (altura * largura, 3) dos pixels, sem copia.
+        """
+        if self.__pixels is None:
+            return None
+        return self.get_matriz(escrita).reshape(-1, 3)
 
     def set_pixels(self, pixels):
+        pixels = Imagem.saturar(pixels, self.__maxval)
+        pixels = np.ascontiguousarray(np.reshape(pixels, (self.get_imagem().get_altura(),
+                                                          self.get_imagem().get_largura(), 3)))
+        self.set_compartilhado(self.get_compartilhado() and np.may_share_memory(pixels, self.__pixels))
         self.__pixels = pixels
 
+    def get_matriz(self, escrita: bool = False):
+        if escrita:
+            self.__separar()
+        return self.proteger(self.__pixels)
+
+    def __separar(self):
+        # Tambem copia buffers somente leitura, como os mapeados com modo_mmap='r'
+        if self.get_compartilhado() or not self.__pixels.flags.writeable:
+            self.__pixels = np.copy(self.__pixels)
+            self.set_compartilhado(False)
+
     def read_maxval(self, arquivo):
-        self.__maxval = int(self.get_imagem().pre_processar_linha(arquivo))
+        self.__maxval = int(self.get_imagem().pre_processar_token(arquivo))
 
     def read_pixels(self, arquivo):
-        imagem = self.get_imagem().pre_processar_resto(arquivo)
-        imagem = np.asarray(imagem.split(), dtype=int)
-        imagem = np.reshape(imagem, (self.get_imagem().get_altura() * self.get_imagem().get_largura(), 3))
-        self.__pixels = imagem
+        forma = (self.get_imagem().get_altura(), self.get_imagem().get_largura(), 3)
+        quantidade = forma[0] * forma[1] * 3
+        if self.get_bruto():
+            imagem = self.get_imagem().pre_processar_bruto(arquivo, quantidade, self.__maxval)
+        else:
+            imagem = self.get_imagem().ler_resto(arquivo, quantidade, self.__maxval)
+        self.__pixels = np.reshape(imagem, forma)
 
     def write_maxval(self, arquivo):
-        arquivo.write(str(self.get_maxval()) + '\n')
+        arquivo.write((str(self.get_maxval()) + '\n').encode('ascii'))
 
     def write_pixels(self, arquivo):
-        bits = [str(p[0]) + ' ' + str(p[1]) + ' ' + str(p[2]) + '\n' for p in self.__pixels]
-        arquivo.writelines(bits)
+        self.write_linhas(arquivo, self.__pixels)
+
+    def get_bytes_linha(self) -> int:
+        return self.get_imagem().get_largura() * 3 * Imagem.get_dtype_bruto(self.__maxval).itemsize
+
+    def read_linhas(self, arquivo, quantidade: int, pendentes: list):
+        largura = self.get_imagem().get_largura()
+        if self.get_bruto():
+            linhas = Imagem.ler_bruto(arquivo, quantidade * largura * 3, self.__maxval)
+        else:
+            linhas = self.get_imagem().pre_processar_amostras(arquivo, quantidade * largura * 3, pendentes)
+            linhas = Imagem.estreitar_amostras(np.asarray(linhas, dtype=np.int64), self.__maxval)
+        return np.reshape(linhas, (quantidade, largura, 3))
+
+    def write_linhas(self, arquivo, linhas):
+        if self.get_bruto():
+            Imagem.escrever_bruto(arquivo, linhas, self.__maxval)
+            return
+
+        Imagem.escrever_plain(arquivo, linhas, self.__maxval, 3)
 
     def clonar(self, imagem: 'Imagem'):
-        clone = FormatoPPM(imagem)
+        clone = FormatoPPM(imagem, self.get_bruto())
         clone.__maxval = self.__maxval
-        clone.__pixels = np.copy(self.__pixels)
+        clone.__pixels = self.__pixels
+        clone.set_compartilhado(True)
+        self.set_compartilhado(True)
+        return clone
+
+
+class FormatoPAM(FormatoImagem):
+    """
+        PAM (P7), sempre binario: http://netpbm.sourceforge.net/doc/pam.html
+        Os pixels ficam num array (altura, largura, DEPTH), lido sem copias do arquivo.
+    """
+    def __init__(self, imagem):
+        FormatoImagem.__init__(self, imagem, True)
+
+        self.__maxval = 255
+        self.__profundidade = 4
+        self.__tipo_tupla = 'RGB_ALPHA'
+        self.__pixels = None
+
+    def get_binario(self) -> bool:
+        return False
+
+    def get_canais(self) -> int:
+        return self.__profundidade
+
+    def get_alfa(self) -> bool:
+        """
+        Indica se o ultimo canal e opacidade (TUPLTYPE terminado em _ALPHA).
+        """
+        return self.__tipo_tupla.endswith('_ALPHA')
+
+    def get_tipo_tupla(self) -> str:
+        return self.__tipo_tupla
+
+    def set_tipo_tupla(self, tipo_tupla: str):
+        self.__tipo_tupla = tipo_tupla
+
+    def get_maxval(self) -> int:
+        return self.__maxval
+
+    def set_maxval(self, maxval: int):
+        self.__maxval = maxval
+        if self.__pixels is not None:
+            self.__pixels = Imagem.saturar(self.__pixels, maxval)
+
+    def get_extensao(self) -> str:
+        return '.pam'
+
+    def get_pixel(self, x, y) -> Cor:
+        if self.__pixels is None:
+            raise Exception()
+
+        p = [Imagem.get_cor_255(c, self.__maxval) for c in self.__pixels[x, y]]
+        if self.__profundidade < 3:
+            return Cor(p[0], p[0], p[0])
+        return Cor(p[0], p[1], p[2])
+
+    def set_pixel(self, x, y, cor: Cor or int):
+        if self.__pixels is None:
+            raise Exception()
+
+        self.__separar()
+        if type(cor) == int:
+            self.__pixels[x, y, 0] = cor % self.__maxval
+        elif type(cor) == Cor and self.__profundidade >= 3:
+            self.__pixels[x, y, 0] = Imagem.get_cor_maxval(cor.get_r(), self.__maxval)
+            self.__pixels[x, y, 1] = Imagem.get_cor_maxval(cor.get_g(), self.__maxval)
+            self.__pixels[x, y, 2] = Imagem.get_cor_maxval(cor.get_b(), self.__maxval)
+        else:
+            raise Exception()
+
+    def get_pixels(self, escrita: bool = False):
+        """
+        Visao (altura * largura, DEPTH) dos pixels, sem copia.
+        """
+        if self.__pixels is None:
+            return None
+        return self.get_matriz(escrita).reshape(-1, self.__profundidade)
+
+    def set_pixels(self, pixels):
+        """
+        :param pixels: (altura, largura, DEPTH), (altura * largura, DEPTH) ou plano
+        """
+        pixels = Imagem.saturar(pixels, self.__maxval)
+        if pixels.ndim > 1:
+            self.__profundidade = pixels.shape[-1]
+        pixels = np.ascontiguousarray(np.reshape(pixels, (self.get_imagem().get_altura(),
+                                                          self.get_imagem().get_largura(),
+                                                          self.__profundidade)))
+        self.set_compartilhado(self.get_compartilhado() and np.may_share_memory(pixels, self.__pixels))
+        self.__pixels = pixels
+
+    def get_matriz(self, escrita: bool = False):
+        if escrita:
+            self.__separar()
+        return self.proteger(self.__pixels)
+
+    def __separar(self):
+        # Tambem copia buffers somente leitura, como os mapeados com modo_mmap='r'
+        if self.get_compartilhado() or not self.__pixels.flags.writeable:
+            self.__pixels = np.copy(self.__pixels)
+            self.set_compartilhado(False)
+
+    def set_matriz(self, matriz):
+        matriz = np.asarray(matriz)
+        if matriz.ndim == 2:
+            matriz = matriz[:, :, np.newaxis]
+        self.set_pixels(matriz)
+
+    def read_cabecalho(self, arquivo):
+        """
+        Le as linhas "CHAVE valor" do cabecalho ate ENDHDR. Varias linhas TUPLTYPE sao juntadas
+        com espaco, como manda a especificacao.
+        """
+        imagem = self.get_imagem()
+        valores = {}
+        tipos_tupla = []
+        while True:
+            linha = arquivo.readline()
+            if not linha:
+                raise Exception('Cabeçalho PAM incompleto: ENDHDR não encontrado.')
+
+            linha = linha.decode('ascii', 'replace').strip()
+            if linha.startswith('#'):
+                comentario = linha[1:].strip()
+                if len(comentario) > 0:
+                    imagem.adicionar_comentario(comentario)
+                continue
+            if len(linha) == 0:
+                continue
+
+            partes = linha.split(None, 1)
+            chave = partes[0]
+            if chave == 'ENDHDR':
+                break
+            if chave == 'TUPLTYPE':
+                if len(partes) > 1:
+                    tipos_tupla.append(partes[1])
+            else:
+                valores[chave] = int(partes[1])
+
+        for chave in ('WIDTH', 'HEIGHT', 'DEPTH', 'MAXVAL'):
+            if chave not in valores:
+                raise Exception('Cabeçalho PAM sem ' + chave + '.')
+        if not 1 <= valores['MAXVAL'] <= 65535:
+            raise Exception('MAXVAL inválido: ' + str(valores['MAXVAL']))
+
+        imagem.set_largura(valores['WIDTH'])
+        imagem.set_altura(valores['HEIGHT'])
+        self.__profundidade = valores['DEPTH']
+        self.__maxval = valores['MAXVAL']
+        self.__tipo_tupla = ' '.join(tipos_tupla)
+
+    def read_pixels(self, arquivo):
+        forma = (self.get_imagem().get_altura(), self.get_imagem().get_largura(), self.__profundidade)
+        imagem = self.get_imagem().pre_processar_bruto(arquivo, forma[0] * forma[1] * forma[2], self.__maxval)
+        self.__pixels = np.reshape(imagem, forma)
+
+    def write_cabecalho(self, arquivo):
+        imagem = self.get_imagem()
+        cabecalho = 'WIDTH %d\nHEIGHT %d\nDEPTH %d\nMAXVAL %d\n' % (imagem.get_largura(), imagem.get_altura(),
+                                                                  self.__profundidade, self.__maxval)
+        if len(self.__tipo_tupla) > 0:
+            cabecalho = cabecalho + 'TUPLTYPE ' + self.__tipo_tupla + '\n'
+        arquivo.write((cabecalho + 'ENDHDR\n').encode('ascii'))
+
+    def write_pixels(self, arquivo):
+        self.write_linhas(arquivo, self.__pixels)
+
+    def get_bytes_linha(self) -> int:
+        return (self.get_imagem().get_largura() * self.__profundidade
+                * Imagem.get_dtype_bruto(self.__maxval).itemsize)
+
+    def read_linhas(self, arquivo, quantidade: int, pendentes: list):
+        largura = self.get_imagem().get_largura()
+        linhas = Imagem.ler_bruto(arquivo, quantidade * largura * self.__profundidade, self.__maxval)
+        return np.reshape(linhas, (quantidade, largura, self.__profundidade))
+
+    def write_linhas(self, arquivo, linhas):
+        Imagem.escrever_bruto(arquivo, linhas, self.__maxval)
+
+    def clonar(self, imagem: 'Imagem'):
+        clone = FormatoPAM(imagem)
+        clone.__maxval = self.__maxval
+        clone.__profundidade = self.__profundidade
+        clone.__tipo_tupla = self.__tipo_tupla
+        clone.__pixels = self.__pixels
+        clone.set_compartilhado(True)
+        self.set_compartilhado(True)
         return clone
 
 
@@ -287,12 +775,244 @@ class FormatoImagemFactory:
             return FormatoPGM(imagem)
         elif imagem.get_tipo() == 'P3':
             return FormatoPPM(imagem)
-        elif imagem.get_tipo() == 'P4' or imagem.get_tipo() == 'P5' or imagem.get_tipo() == 'P6':
-            print('Formatos binários nao foram implementados, utilize formatos em plain-text.')
-            raise Exception()
+        elif imagem.get_tipo() == 'P4':
+            return FormatoPBM(imagem, True)
+        elif imagem.get_tipo() == 'P5':
+            return FormatoPGM(imagem, True)
+        elif imagem.get_tipo() == 'P6':
+            return FormatoPPM(imagem, True)
+        elif imagem.get_tipo() == 'P7':
+            return FormatoPAM(imagem)
         return None
 
 
+class ArmazenamentoTiles:
+    """
+        Pixels de uma imagem divididos em tiles de `tamanho` x `tamanho`, decodificados sob demanda
+        e mantidos num cache LRU limitado a `orcamento` bytes.
+
+        Um tile vem, nesta ordem, do cache, do arquivo de rascunho (tiles alterados que sairam do
+        cache) ou da origem: o arquivo binario mapeado, quando houver. Sem nenhum deles o tile e
+        todo 0. Cada tile tem a forma (linhas, colunas) ou (linhas, colunas, canais), com o tipo
+        compacto de maxval.
+    """
+    def __init__(self, altura: int, largura: int, forma_pixel: tuple, dtype,
+                 orcamento: int = ORCAMENTO_TILES, tamanho: int = TAMANHO_TILE):
+        self.__altura = altura
+        self.__largura = largura
+        self.__forma_pixel = tuple(forma_pixel)
+        self.__dtype = np.dtype(dtype)
+        self.__orcamento = orcamento
+        self.__tamanho = tamanho
+
+        self.__tiles_x = (altura + tamanho - 1) // tamanho
+        self.__tiles_y = (largura + tamanho - 1) // tamanho
+        self.__cache = OrderedDict()
+        self.__sujos = set()
+        self.__usado = 0
+
+        self.__origem = None
+        self.__origem_bits = False
+        self.__rascunho = None
+        self.__no_rascunho = np.zeros((self.__tiles_x, self.__tiles_y), dtype=bool)
+
+    def get_tamanho(self) -> int:
+        return self.__tamanho
+
+    def get_tiles_x(self) -> int:
+        return self.__tiles_x
+
+    def get_tiles_y(self) -> int:
+        return self.__tiles_y
+
+    def get_usado(self) -> int:
+        """
+        Bytes dos tiles atualmente no cache.
+        """
+        return self.__usado
+
+    def get_arquivo_origem(self) -> str or None:
+        """
+        Caminho do arquivo mapeado como origem, se os tiles ainda dependem dele.
+        """
+        if self.__origem is None:
+            return None
+        return self.__origem.filename
+
+    def mapear(self, caminho: str, inicio: int, dtype_bruto, bits: bool = False):
+        """
+        Usa como origem os pixels binarios de um arquivo nao comprimido, a partir de `inicio`.
+        O arquivo e mapeado somente leitura: so as paginas dos tiles decodificados sao lidas.
+
+        :param bits: pixels empacotados 8 por byte, como no P4
+        """
+        if bits:
+            forma = (self.__altura, (self.__largura + 7) // 8)
+        else:
+            forma = (self.__altura, self.__largura) + self.__forma_pixel
+        tamanho = int(np.prod(forma)) * np.dtype(dtype_bruto).itemsize
+        disponivel = os.path.getsize(caminho) - inicio
+        if disponivel < tamanho:
+            raise Exception('Arquivo incompleto: esperados %d bytes de pixels, encontrados %d.'
+                            % (tamanho, disponivel))
+
+        self.__origem = np.memmap(caminho, dtype=dtype_bruto, mode='r', offset=inicio, shape=forma)
+        self.__origem_bits = bits
+
+    def importar(self, faixas):
+        """
+        Grava no rascunho os tiles de uma sequencia de faixas de `tamanho` linhas (a ultima pode
+        ter menos), como as lidas em sequencia de arquivos plain-text ou comprimidos.
+        """
+        x = 0
+        for faixa in faixas:
+            i = x // self.__tamanho
+            for j in range(self.__tiles_y):
+                y = j * self.__tamanho
+                self.__gravar(i, j, faixa[:, y:y + self.__tamanho])
+            x = x + len(faixa)
+        if x != self.__altura:
+            raise Exception('Imagem incompleta: %d de %d linhas lidas.' % (x, self.__altura))
+
+    def desvincular(self):
+        """
+        Copia para o rascunho os tiles que ainda so existem na origem e deixa de usa-la, para que
+        o arquivo de origem possa ser sobrescrito.
+        """
+        if self.__origem is None:
+            return
+        for i in range(self.__tiles_x):
+            for j in range(self.__tiles_y):
+                if not self.__no_rascunho[i, j] and (i, j) not in self.__sujos:
+                    self.__gravar(i, j, self.__decodificar(i, j))
+        self.__origem = None
+
+    def get_tile(self, i: int, j: int, escrita: bool = False) -> np.ndarray:
+        """
+        Tile da linha i e coluna j da grade de tiles.
+
+        :param escrita: marca o tile como alterado e retorna o array do proprio cache. Alteracoes
+                        so sao garantidas ate o proximo acesso a outro tile, que pode tira-lo do cache.
+        """
+        chave = (i, j)
+        tile = self.__cache.get(chave)
+        if tile is None:
+            tile = self.__ler(i, j)
+            self.__cache[chave] = tile
+            self.__usado = self.__usado + tile.nbytes
+            self.__liberar()
+        else:
+            self.__cache.move_to_end(chave)
+
+        if escrita:
+            self.__sujos.add(chave)
+            return tile
+        visao = tile.view()
+        visao.flags.writeable = False
+        return visao
+
+    def get_regiao(self, x: int, y: int, altura: int, largura: int) -> np.ndarray:
+        """
+        Copia do bloco de pixels a partir da linha x e coluna y, montada dos tiles que ele toca.
+        """
+        regiao = np.empty((altura, largura) + self.__forma_pixel, dtype=self.__dtype)
+        for i, j, dx, dy, tx, ty, h, w in self.__cortes(x, y, altura, largura):
+            regiao[dx:dx + h, dy:dy + w] = self.get_tile(i, j)[tx:tx + h, ty:ty + w]
+        return regiao
+
+    def set_regiao(self, x: int, y: int, valores: np.ndarray):
+        altura, largura = valores.shape[:2]
+        for i, j, dx, dy, tx, ty, h, w in self.__cortes(x, y, altura, largura):
+            self.get_tile(i, j, True)[tx:tx + h, ty:ty + w] = valores[dx:dx + h, dy:dy + w]
+
+    def clonar(self) -> 'ArmazenamentoTiles':
+        """
+        Copia com a mesma origem e uma copia do rascunho. O cache do clone comeca vazio. Antes de
+        sobrescrever o arquivo de origem, todos os clones devem ser desvinculados.
+        """
+        for chave in list(self.__sujos):
+            self.__gravar(chave[0], chave[1], self.__cache[chave])
+
+        clone = ArmazenamentoTiles(self.__altura, self.__largura, self.__forma_pixel, self.__dtype,
+                                   self.__orcamento, self.__tamanho)
+        clone.__origem = self.__origem
+        clone.__origem_bits = self.__origem_bits
+        clone.__no_rascunho = np.copy(self.__no_rascunho)
+        if self.__rascunho is not None:
+            clone.__rascunho = tempfile.TemporaryFile()
+            self.__rascunho.seek(0)
+            shutil.copyfileobj(self.__rascunho, clone.__rascunho, TAMANHO_BUFFER)
+        return clone
+
+    def fechar(self):
+        self.__cache.clear()
+        self.__sujos.clear()
+        self.__usado = 0
+        self.__origem = None
+        if self.__rascunho is not None:
+            self.__rascunho.close()
+            self.__rascunho = None
+
+    def __cortes(self, x: int, y: int, altura: int, largura: int):
+        # Para cada tile tocado: posicao na regiao, posicao no tile e tamanho do pedaco
+        t = self.__tamanho
+        for i in range(x // t, (x + altura + t - 1) // t):
+            x0 = max(x, i * t)
+            h = min(x + altura, (i + 1) * t) - x0
+            for j in range(y // t, (y + largura + t - 1) // t):
+                y0 = max(y, j * t)
+                w = min(y + largura, (j + 1) * t) - y0
+                yield i, j, x0 - x, y0 - y, x0 - i * t, y0 - j * t, h, w
+
+    def __get_forma_tile(self, i: int, j: int) -> tuple:
+        t = self.__tamanho
+        return ((min(t, self.__altura - i * t), min(t, self.__largura - j * t))
+                + self.__forma_pixel)
+
+    def __get_posicao(self, i: int, j: int) -> int:
+        # Cada tile tem um espaco fixo no rascunho, do tamanho de um tile completo
+        t = self.__tamanho
+        espaco = t * t * int(np.prod(self.__forma_pixel)) * self.__dtype.itemsize
+        return (i * self.__tiles_y + j) * espaco
+
+    def __ler(self, i: int, j: int) -> np.ndarray:
+        if self.__no_rascunho[i, j]:
+            tile = np.empty(self.__get_forma_tile(i, j), dtype=self.__dtype)
+            self.__rascunho.seek(self.__get_posicao(i, j))
+            self.__rascunho.readinto(memoryview(tile).cast('B'))
+            return tile
+        if self.__origem is not None:
+            return self.__decodificar(i, j)
+        return np.zeros(self.__get_forma_tile(i, j), dtype=self.__dtype)
+
+    def __decodificar(self, i: int, j: int) -> np.ndarray:
+        t = self.__tamanho
+        x, y = i * t, j * t
+        h, w = self.__get_forma_tile(i, j)[:2]
+        if self.__origem_bits:
+            # y e multiplo de 8: o tile comeca no primeiro bit de um byte
+            bits = self.__origem[x:x + h, y // 8:(y + w + 7) // 8]
+            return np.unpackbits(bits, axis=1, count=w)
+        return self.__origem[x:x + h, y:y + w].astype(self.__dtype)
+
+    def __gravar(self, i: int, j: int, tile: np.ndarray):
+        if self.__rascunho is None:
+            self.__rascunho = tempfile.TemporaryFile()
+        tile = np.ascontiguousarray(tile, dtype=self.__dtype)
+        self.__rascunho.seek(self.__get_posicao(i, j))
+        self.__rascunho.write(tile.data)
+        self.__no_rascunho[i, j] = True
+        self.__sujos.discard((i, j))
+
+    def __liberar(self):
+        # Tira os tiles usados ha mais tempo, sempre mantendo o ultimo pedido
+        while self.__usado > self.__orcamento and len(self.__cache) > 1:
+            chave, tile = self.__cache.popitem(last=False)
+            if chave in self.__sujos:
+                self.__gravar(chave[0], chave[1], tile)
+            self.__usado = self.__usado - tile.nbytes
+
+
 class Imagem:
     """
         Classe que reconhece arquivos de imagem.
@@ -301,7 +1021,16 @@ class Imagem:
           http://netpbm.sourceforge.net/doc/pbm.html
           http://netpbm.sourceforge.net/doc/pgm.html
           http://netpbm.sourceforge.net/doc/ppm.html
+          http://netpbm.sourceforge.net/doc/pam.html
+
+        Os formatos plain-text (P1, P2 e P3) e binarios (P4, P5, P6 e P7) sao
+        suportados. Nos formatos binarios os pixels sao lidos de uma vez so,
+        direto para um array numpy, logo apos o cabecalho.
     """
+    # Imagens (e clones) com pixels mapeados de arquivos, desvinculadas antes que um deles seja
+    # sobrescrito: truncar um arquivo mapeado derruba o processo com SIGBUS ao acessar os pixels
+    __mapeadas = weakref.WeakSet()
+
     def __init__(self):
         self.__altura = -1
         self.__largura = -1
@@ -310,6 +1039,13 @@ class Imagem:
         self.__comentario = ''
         self.__erro = ''
         self.__formato = None
+        self.__modo_mmap = None
+        self.__buffer_leitura = None
+        self.__processos = 1
+        self.__inicio_pixels = None
+        self.__tiles = None
+        self.__piramide = None
+        self.__integrais = {}
 
     def get_largura(self) -> int:
         return self.__largura
@@ -328,6 +1064,24 @@ class Imagem:
             raise Exception()
         return self.__formato.get_binario()
 
+    def get_bruto(self) -> bool:
+        if self.__formato is None:
+            raise Exception()
+        return self.__formato.get_bruto()
+
+    def get_canais(self) -> int:
+        """
+        Amostras por pixel: 1 no PBM e no PGM, 3 no PPM e DEPTH no PAM.
+        """
+        if self.__formato is None:
+            raise Exception()
+        return self.__formato.get_canais()
+
+    def get_alfa(self) -> bool:
+        if self.__formato is None:
+            raise Exception()
+        return self.__formato.get_alfa()
+
     def get_caminho(self) -> str:
         return self.__caminho
 
@@ -337,6 +1091,23 @@ class Imagem:
     def set_tipo(self, tipo: str):
         self.__tipo = tipo
         self.__formato = FormatoImagemFactory.get_formato(self)
+        self.__inicio_pixels = None
+        self.__descartar_derivados()
+        self.__descartar_tiles()
+
+    def get_tipo_plain(self) -> str:
+        """
+        Retorna o tipo plain-text equivalente (P1, P2 ou P3), seja a imagem binaria ou nao.
+        """
+        return TIPOS_PLAIN.get(self.__tipo, self.__tipo)
+
+    def set_tipo_plain(self, tipo: str):
+        """
+        Altera o tipo mantendo a codificacao (plain-text ou binaria) atual da imagem.
+        """
+        if self.__formato is not None and self.__formato.get_bruto():
+            tipo = TIPOS_BRUTOS.get(tipo, tipo)
+        self.set_tipo(tipo)
 
     def get_comentario(self) -> str:
         return self.__comentario
@@ -355,6 +1126,8 @@ class Imagem:
     def set_maxval(self, maxval: int):
         if self.__formato is None:
             raise Exception()
+        self.__carregar_pendentes()
+        self.__descartar_derivados()
         self.__formato.set_maxval(maxval)
 
     def get_extensao(self) -> int:
@@ -363,36 +1136,390 @@ class Imagem:
         return self.__formato.get_extensao()
 
     def get_pixel(self, x, y) -> Cor or None:
-        if x < 0 or x >= self.__largura or y < 0 or y >= self.__altura:
+        """
+        :param x: linha
+        :param y: coluna
+        """
+        if x < 0 or x >= self.__altura or y < 0 or y >= self.__largura:
             return None
         if self.__formato is None:
             raise Exception()
+        if self.__tiles is not None:
+            p = self.get_regiao(x, y, 1, 1).reshape(-1)
+            if len(p) < 3:
+                return Cor(int(p[0]), int(p[0]), int(p[0]))
+            return Cor(int(p[0]), int(p[1]), int(p[2]))
+        self.__carregar_pendentes()
         return self.__formato.get_pixel(x, y)
 
     def set_pixel(self, x, y, cor: Cor or int):
         if self.__formato is None:
             raise Exception()
+        self.__descartar_derivados()
+        if self.__tiles is not None:
+            self.__set_pixel_tiles(x, y, cor)
+            return
+        self.__carregar_pendentes()
         self.__formato.set_pixel(x, y, cor)
 
-    def get_pixels(self):
+    def __set_pixel_tiles(self, x, y, cor: Cor or int):
+        # Mesmas regras do set_pixel de cada formato, escrevendo direto no tile
+        regiao = self.get_regiao(x, y, 1, 1, False)
+        p = regiao.reshape(-1)
+        if type(cor) == int and self.__tipo not in ('P3', 'P6'):
+            if self.__formato.get_binario():
+                p[0] = cor % 2
+            else:
+                p[0] = cor % self.get_maxval()
+        elif type(cor) == Cor and self.get_canais() >= 3:
+            p[:3] = Imagem.get_cores_maxval([cor.get_r(), cor.get_g(), cor.get_b()], self.get_maxval())
+        else:
+            raise Exception()
+        self.__tiles.set_regiao(x, y, regiao)
+
+    def get_pixels(self, escrita: bool = False):
+        """
+        Pixels em forma plana: (altura * largura) ou (altura * largura, canais). E uma visao da
+        matriz, sem copia (exceto no PBM, que guarda os pixels empacotados).
+
+        :param escrita: True para alterar os pixels no lugar. Sem ele, pixels compartilhados com
+                        um clone sao somente leitura.
+        """
         if self.__formato is None:
             raise Exception()
-        return self.__formato.get_pixels()
+        self.__carregar_pendentes()
+        if escrita:
+            self.__descartar_derivados()
+        return self.__formato.get_pixels(escrita)
 
     def set_pixels(self, pixels):
+        """
+        :param pixels: na forma plana ou na da matriz, com as dimensoes atuais da imagem
+        """
         if self.__formato is None:
             raise Exception()
+        self.__inicio_pixels = None
+        self.__descartar_derivados()
+        self.__descartar_tiles()
         self.__formato.set_pixels(pixels)
 
-    def get_pixel_index(self, x: int, y: int) -> int:
-        return (x * self.get_largura()) + y
+    def get_matriz(self, escrita: bool = False):
+        """
+        Pixels como array C-contiguo (altura, largura) ou (altura, largura, canais).
+        """
+        if self.__formato is None:
+            raise Exception()
+        self.__carregar_pendentes()
+        if escrita:
+            self.__descartar_derivados()
+        return self.__formato.get_matriz(escrita)
+
+    def set_matriz(self, matriz):
+        """
+        Troca os pixels, atualizando altura e largura pela forma da matriz.
+        """
+        if self.__formato is None:
+            raise Exception()
+        matriz = np.asarray(matriz)
+        self.__altura = matriz.shape[0]
+        self.__largura = matriz.shape[1]
+        self.__inicio_pixels = None
+        self.__descartar_derivados()
+        self.__descartar_tiles()
+        self.__formato.set_matriz(matriz)
+
+    def get_regiao(self, x: int, y: int, altura: int, largura: int, escala_255: bool = True) -> np.ndarray:
+        """
+        Bloco de pixels a partir da linha x e coluna y, como array (altura, largura) ou
+        (altura, largura, canais).
+
+        :param escala_255: converte as amostras de 0..maxval para 0..255, como get_pixel. Sem a
+                           conversao, retorna uma visao dos pixels (uma copia, se a imagem estiver
+                           em tiles).
+        """
+        if self.__formato is None:
+            raise Exception()
+        self.__validar_regiao(x, y, altura, largura)
+
+        if self.__tiles is not None:
+            regiao = self.__tiles.get_regiao(x, y, altura, largura)
+        else:
+            regiao = self.get_matriz()[x:x + altura, y:y + largura]
+        if not escala_255:
+            return regiao
+        return Imagem.get_cores_255(regiao, self.get_maxval())
+
+    def set_regiao(self, x: int, y: int, valores, escala_255: bool = True):
+        """
+        Escreve um bloco (altura, largura) ou (altura, largura, canais) de pixels a partir da linha
+        x e coluna y.
+
+        :param escala_255: os valores estao em 0..255 e sao convertidos para 0..maxval
+        """
+        if self.__formato is None:
+            raise Exception()
+        valores = np.asarray(valores)
+        altura, largura = valores.shape[:2]
+        self.__validar_regiao(x, y, altura, largura)
 
-    def get_pixel_position(self, index) -> (int, int):
-        linha = int(index / self.get_largura())
-        coluna = index % self.get_largura()
-        return linha, coluna
+        if escala_255:
+            valores = Imagem.get_cores_maxval(valores, self.get_maxval())
+        else:
+            valores = Imagem.saturar(valores, self.get_maxval())
+
+        self.__descartar_derivados()
+        if self.__tiles is not None:
+            self.__tiles.set_regiao(x, y, valores)
+        elif self.__formato.get_binario():
+            # A matriz de uma imagem binaria e uma copia desempacotada
+            matriz = self.get_matriz()
+            matriz[x:x + altura, y:y + largura] = valores
+            self.set_pixels(matriz)
+        else:
+            self.get_matriz(escrita=True)[x:x + altura, y:y + largura] = valores
+
+    def __validar_regiao(self, x: int, y: int, altura: int, largura: int):
+        if x < 0 or y < 0 or altura < 0 or largura < 0 or x + altura > self.__altura \
+                or y + largura > self.__largura:
+            raise Exception('Região fora da imagem: %dx%d em (%d, %d).' % (largura, altura, x, y))
+
+    def get_pixels_empacotados(self):
+        """
+        Pixels de uma imagem binaria, 8 por byte, com uma linha da imagem por linha da matriz.
+        """
+        if self.__formato is None or not self.__formato.get_binario():
+            raise Exception()
+        self.__carregar_pendentes()
+        return self.__formato.get_pixels_empacotados()
+
+    def set_pixels_empacotados(self, bits):
+        if self.__formato is None or not self.__formato.get_binario():
+            raise Exception()
+        self.__inicio_pixels = None
+        self.__descartar_derivados()
+        self.__descartar_tiles()
+        self.__formato.set_pixels_empacotados(bits)
+
+    def get_pendente(self) -> bool:
+        """
+        Indica se a imagem foi carregada em modo preguicoso e os pixels ainda nao foram lidos.
+        """
+        return self.__inicio_pixels is not None
+
+    def get_em_tiles(self) -> bool:
+        """
+        Indica se os pixels estao em tiles (carregar com tiles=True). O acesso a imagem inteira,
+        por get_pixels, get_matriz ou get_pixels_empacotados, junta os tiles de volta num array.
+        """
+        return self.__tiles is not None
+
+    def iterar_tiles(self, escrita: bool = False):
+        """
+        Percorre os pixels em blocos, produzindo (x, y, tile): linha e coluna do primeiro pixel e
+        o array (linhas, colunas) ou (linhas, colunas, canais) do bloco. Nas imagens em tiles so o
+        tile atual precisa estar na memoria; nas demais ha um unico bloco, com a imagem inteira.
+
+        :param escrita: os tiles podem ser alterados no lugar, ate o proximo ser pedido
+        """
+        if self.__formato is None:
+            raise Exception()
+        if escrita:
+            self.__descartar_derivados()
+
+        if self.__tiles is not None:
+            tamanho = self.__tiles.get_tamanho()
+            for i in range(self.__tiles.get_tiles_x()):
+                for j in range(self.__tiles.get_tiles_y()):
+                    yield i * tamanho, j * tamanho, self.__tiles.get_tile(i, j, escrita)
+            return
+
+        matriz = self.get_matriz(escrita)
+        try:
+            yield 0, 0, matriz
+        finally:
+            # A matriz de uma imagem binaria e uma copia desempacotada
+            if escrita and self.__formato.get_binario():
+                self.set_pixels(matriz)
+
+    def get_niveis(self) -> int:
+        """
+        Quantidade de niveis da piramide de resolucoes, do nivel 0 (a propria imagem) ao de 1x1.
+        """
+        return max(self.__altura - 1, self.__largura - 1, 0).bit_length() + 1
+
+    def get_nivel(self, nivel: int) -> np.ndarray:
+        """
+        Nivel da piramide de resolucoes, em 0..255 como get_regiao, mas com os tons exibidos: no
+        PBM 1 e preto, como no netpbm. Cada nivel tem metade da altura e da largura do anterior
+        (arredondadas para cima) e cada pixel e a media dos 2x2 que cobre. Os niveis sao calculados
+        no primeiro pedido e mantidos ate a proxima alteracao dos pixels.
+        """
+        if nivel < 0 or nivel >= self.get_niveis():
+            raise Exception('Nível inválido: %d.' % nivel)
+        if nivel == 0:
+            return self.__exibir(self.get_regiao(0, 0, self.__altura, self.__largura))
+
+        if self.__piramide is None:
+            self.__piramide = [self.__reduzir_imagem()]
+        while len(self.__piramide) < nivel:
+            soma = Imagem.somar_2x2(self.__piramide[-1])
+            self.__piramide.append(Imagem.proteger_nivel(np.rint(soma / 4.0).astype(np.uint8)))
+        return self.__piramide[nivel - 1]
+
+    def get_nivel_escala(self, escala: float) -> int:
+        """
+        Nivel mais reduzido que ainda tem ao menos um pixel por pixel exibido, para mostrar a
+        imagem com `escala` pixels na tela por pixel da imagem.
+        """
+        if escala >= 1:
+            return 0
+        return min(int(np.floor(np.log2(1.0 / escala))), self.get_niveis() - 1)
+
+    def get_visualizacao(self, x: int, y: int, altura: int, largura: int, escala: float) -> np.ndarray:
+        """
+        Regiao visivel da imagem (linha x, coluna y, altura e largura no nivel 0), lida do nivel
+        indicado por get_nivel_escala. No nivel 0 so os pixels (ou tiles) da regiao sao lidos.
+        """
+        nivel = self.get_nivel_escala(escala)
+        if nivel == 0:
+            return self.__exibir(self.get_regiao(x, y, altura, largura))
+
+        f = 1 << nivel
+        return self.get_nivel(nivel)[x // f:(x + altura + f - 1) // f, y // f:(y + largura + f - 1) // f]
+
+    def __reduzir_imagem(self) -> np.ndarray:
+        # Nivel 1 direto dos pixels, tile a tile; os tiles comecam em linhas e colunas pares
+        forma = ((self.__altura + 1) // 2, (self.__largura + 1) // 2)
+        if self.__tipo not in ('P1', 'P2', 'P4', 'P5'):
+            forma = forma + (self.get_canais(),)
+        nivel = np.empty(forma, dtype=np.uint8)
+        fator = 255.0 / (4 * self.get_maxval())
+        for x, y, tile in self.iterar_tiles():
+            reduzido = np.rint(Imagem.somar_2x2(tile) * fator)
+            nivel[x // 2:x // 2 + len(reduzido), y // 2:y // 2 + reduzido.shape[1]] = reduzido
+        return Imagem.proteger_nivel(self.__exibir(nivel))
+
+    def __exibir(self, pixels: np.ndarray) -> np.ndarray:
+        # Tons exibidos: no PBM o bit 1 e preto, ao contrario de get_regiao
+        if self.get_binario():
+            return 255 - pixels
+        return pixels
+
+    def get_integral(self, quadrados: bool = False) -> np.ndarray:
+        """
+        Imagem integral (tabela de somas de area): o elemento (x, y) e a soma dos pixels acima e a
+        esquerda de (x, y), exclusive, entao a forma e (altura + 1, largura + 1[, canais]). Com
+        `quadrados`, soma os quadrados dos pixels. Calculada uma faixa de linhas por vez e mantida
+        ate a proxima alteracao dos pixels.
+        """
+        if quadrados not in self.__integrais:
+            amostra = self.get_regiao(0, 0, 1, 1, False)
+            integral = np.zeros((self.__altura + 1, self.__largura + 1) + amostra.shape[2:], dtype=np.int64)
+            for x in range(0, self.__altura, TAMANHO_TILE):
+                faixa = self.get_regiao(x, 0, min(TAMANHO_TILE, self.__altura - x), self.__largura, False)
+                faixa = faixa.astype(np.int64)
+                if quadrados:
+                    faixa *= faixa
+                integral[x + 1:x + len(faixa) + 1, 1:] = np.cumsum(np.cumsum(faixa, axis=1), axis=0) + integral[x, 1:]
+            integral.flags.writeable = False
+            self.__integrais[quadrados] = integral
+        return self.__integrais[quadrados]
+
+    def get_media_local(self, tamanho: int) -> np.ndarray:
+        """
+        Media de cada janela tamanho x tamanho que cabe inteira na imagem, em tempo constante por
+        pixel qualquer que seja o tamanho: matriz (altura - tamanho + 1, largura - tamanho + 1[, canais]).
+        """
+        return Imagem.somar_janelas(self.get_integral(), tamanho) / float(tamanho * tamanho)
+
+    def get_variancia_local(self, tamanho: int) -> np.ndarray:
+        """
+        Variancia de cada janela tamanho x tamanho, como get_media_local.
+        """
+        n = float(tamanho * tamanho)
+        media = Imagem.somar_janelas(self.get_integral(), tamanho) / n
+        variancia = Imagem.somar_janelas(self.get_integral(True), tamanho) / n - media * media
+        return np.maximum(variancia, 0, out=variancia)
+
+    @staticmethod
+    def somar_janelas(integral: np.ndarray, tamanho: int) -> np.ndarray:
+        """
+        Soma de cada janela tamanho x tamanho, com quatro acessos a imagem integral por janela.
+        """
+        t = tamanho
+        return integral[t:, t:] - integral[:-t, t:] - integral[t:, :-t] + integral[:-t, :-t]
+
+    @staticmethod
+    def somar_2x2(pixels) -> np.ndarray:
+        """
+        Soma de cada bloco 2x2, repetindo a ultima linha ou coluna quando a dimensao e impar.
+        """
+        pixels = np.asarray(pixels)
+        if len(pixels) % 2 != 0:
+            pixels = np.concatenate((pixels, pixels[-1:]), axis=0)
+        if pixels.shape[1] % 2 != 0:
+            pixels = np.concatenate((pixels, pixels[:, -1:]), axis=1)
+        soma = pixels[0::2, 0::2].astype(np.uint32)
+        soma += pixels[1::2, 0::2]
+        soma += pixels[0::2, 1::2]
+        soma += pixels[1::2, 1::2]
+        return soma
+
+    @staticmethod
+    def proteger_nivel(nivel: np.ndarray) -> np.ndarray:
+        # Niveis sao compartilhados com os clones e nunca alterados no lugar
+        nivel.flags.writeable = False
+        return nivel
+
+    def __descartar_derivados(self):
+        # Piramide e imagens integrais deixam de valer quando os pixels mudam
+        self.__piramide = None
+        self.__integrais = {}
+
+    def __descartar_tiles(self):
+        if self.__tiles is not None:
+            self.__tiles.fechar()
+            self.__tiles = None
+
+    def __carregar_pendentes(self):
+        if self.__tiles is not None:
+            tiles = self.__tiles
+            self.__tiles = None
+            self.__formato.set_matriz(tiles.get_regiao(0, 0, self.__altura, self.__largura))
+            tiles.fechar()
+
+        if self.__inicio_pixels is None:
+            return
+
+        with Imagem.abrir(self.__caminho, 'rb') as arquivo:
+            arquivo.seek(self.__inicio_pixels)
+            self.__inicio_pixels = None
+            self.__formato.read_pixels(arquivo)
+
+    def get_modo_mmap(self) -> str or None:
+        return self.__modo_mmap
+
+    def carregar(self, caminho, modo_mmap: str or None = None, preguicoso: bool = False,
+                 processos: int = 1, tiles: bool = False, orcamento_tiles: int = ORCAMENTO_TILES):
+        """
+        :param modo_mmap: None para ler os pixels para a memoria, 'r' para mapear o arquivo somente
+                          leitura ou 'c' para mapear com copy-on-write. O mapeamento vale apenas
+                          para P5 e P6 nao comprimidos; os demais casos sao sempre lidos para a
+                          memoria.
+        :param preguicoso: le apenas o cabecalho (tipo, dimensoes, maxval e comentarios) e guarda a
+                           posicao dos pixels, que sao lidos no primeiro acesso a eles. Comentarios
+                           no meio dos pixels plain-text so aparecem depois desse acesso.
+        :param processos: quantidade de processos para ler os pixels de P2 e P3 grandes. Usa fork,
+                          entao nos sistemas sem fork (e em arquivos comprimidos) a leitura e serial.
+        :param tiles: guarda os pixels em tiles de TAMANHO_TILE x TAMANHO_TILE, com no maximo
+                      `orcamento_tiles` bytes deles na memoria. P4, P5, P6 e P7 nao comprimidos sao
+                      decodificados direto do arquivo, tile a tile; os demais sao lidos uma vez para
+                      um arquivo de rascunho temporario.
+        """
+        if modo_mmap not in MODOS_MMAP:
+            self.__erro = 'Modo de mapeamento inválido: ' + str(modo_mmap)
+            return False
 
-    def carregar(self, caminho):
         try:
             # Resetar valores
             self.__altura = -1
@@ -402,113 +1529,478 @@ class Imagem:
             self.__comentario = ''
             self.__erro = None
             self.__formato = None
+            self.__modo_mmap = modo_mmap
+            self.__buffer_leitura = None
+            self.__inicio_pixels = None
+            self.__processos = processos
+            self.__descartar_derivados()
+            self.__descartar_tiles()
 
             # Abrir arquivo
-            arquivo = open(caminho, 'r')
-
-            # Ler tipo
-            self.__tipo = self.pre_processar_linha(arquivo)
-
-            # Pegar formato
-            self.__formato = FormatoImagemFactory.get_formato(self)
-            if self.__formato is None:
-                self.__erro = 'Não foi possível reconhecer o arquivo.'
-                return False
-
-            # Ler dimensoes
-            dimensoes = self.pre_processar_linha(arquivo)
-            dimensoes = dimensoes.split()
-            self.__largura = int(dimensoes[0])
-            self.__altura = int(dimensoes[1])
-
-            # Ler maxval
-            self.__formato.read_maxval(arquivo)
-
-            # Ler pixels
-            self.__formato.read_pixels(arquivo)
+            with Imagem.abrir(caminho, 'rb') as arquivo:
+                # Ler cabecalho
+                if not self.ler_cabecalho(arquivo):
+                    return False
+
+                # Ler pixels, ou apenas guardar onde comecam
+                if tiles:
+                    self.__tiles = self.criar_tiles(arquivo, orcamento_tiles)
+                elif preguicoso:
+                    self.__inicio_pixels = arquivo.tell()
+                else:
+                    self.__formato.read_pixels(arquivo)
             return True
         except Exception as e:
             self.__erro = 'Falha ao carregar arquivo.\n' + str(e)
             return False
 
+    def criar_tiles(self, arquivo, orcamento: int) -> ArmazenamentoTiles:
+        """
+        Tiles dos pixels que comecam na posicao atual do arquivo.
+        """
+        if self.__tipo in ('P1', 'P2', 'P4', 'P5'):
+            forma_pixel = ()
+        else:
+            forma_pixel = (self.get_canais(),)
+        tiles = ArmazenamentoTiles(self.__altura, self.__largura, forma_pixel,
+                                   Imagem.get_dtype(self.get_maxval()), orcamento)
+
+        if self.get_bruto() and not Imagem.get_comprimido(arquivo):
+            binario = self.get_binario()
+            tiles.mapear(self.__caminho, arquivo.tell(),
+                         np.uint8 if binario else Imagem.get_dtype_bruto(self.get_maxval()), binario)
+            Imagem.__mapeadas.add(self)
+            return tiles
+
+        pendentes = []
+        faixas = (self.ler_linhas(arquivo, min(TAMANHO_TILE, self.__altura - x), pendentes)
+                  for x in range(0, self.__altura, TAMANHO_TILE))
+        tiles.importar(faixas)
+        return tiles
+
+    def ler_cabecalho(self, arquivo) -> bool:
+        """
+        Le tipo, dimensoes e maxval, deixando o arquivo posicionado no inicio dos pixels.
+        """
+        # Ler tipo
+        self.__tipo = self.pre_processar_token(arquivo)
+
+        # Pegar formato
+        self.__formato = FormatoImagemFactory.get_formato(self)
+        if self.__formato is None:
+            self.__erro = 'Não foi possível reconhecer o arquivo.'
+            return False
+
+        # Ler dimensoes e maxval
+        self.__formato.read_cabecalho(arquivo)
+        return True
+
     def salvar(self, caminho: str) -> bool:
         try:
+            base, compressao = Imagem.separar_compressao(caminho)
             extensao = self.__formato.get_extensao().lower()
-            if not caminho.lower().endswith(extensao):
-                caminho = caminho + extensao
+            if not base.lower().endswith(extensao):
+                caminho = base + extensao + compressao
 
+            # Os pixels pendentes sao lidos do caminho antigo, antes que ele seja trocado
+            if self.__tiles is None:
+                self.__carregar_pendentes()
+            Imagem.desvincular_arquivo(caminho)
             self.__caminho = caminho
 
             # Abrir arquivo
-            arquivo = open(caminho, 'w')
+            with Imagem.abrir(caminho, 'wb') as arquivo:
+                self.escrever(arquivo)
+            return True
+        except Exception as e:
+            self.__erro = 'Falha ao escrever arquivo.\n' + str(e)
+            return False
+
+    def escrever(self, arquivo):
+        """
+        Escreve a imagem (cabecalho e pixels) na posicao atual de um arquivo ja aberto.
+        """
+        if self.__tiles is None:
+            self.__carregar_pendentes()
 
-            # Escrever tipo
-            arquivo.write(self.__tipo + '\n')
+        # Escrever cabecalho
+        self.escrever_cabecalho(arquivo)
 
-            # Escrever comentarios
-            if self.__comentario is not None and len(self.__comentario) > 0:
-                comentarios = self.__comentario.splitlines()
-                comentarios = ['# ' + c + '\n' for c in comentarios]
-                arquivo.writelines(comentarios)
+        # Escrever pixels; imagens em tiles uma faixa de tiles por vez
+        if self.__tiles is None:
+            self.__formato.write_pixels(arquivo)
+            return
+        for x in range(0, self.__altura, TAMANHO_TILE):
+            faixa = self.__tiles.get_regiao(x, 0, min(TAMANHO_TILE, self.__altura - x), self.__largura)
+            self.__formato.write_linhas(arquivo, faixa)
 
-            # Escrever tamanho
-            arquivo.write(str(self.__largura) + ' ' + str(self.__altura) + '\n')
+    @staticmethod
+    def iterar(caminho: str, modo_mmap: str or None = None, compartilhar_buffer: bool = False):
+        """
+        Percorre todas as imagens de um arquivo com varias imagens concatenadas, como permitido
+        pelo netpbm, usando um unico arquivo aberto.
+
+        :param compartilhar_buffer: le os pixels binarios de todas as imagens no mesmo buffer;
+                                    cada imagem so e valida ate a proxima ser lida.
+        """
+        if modo_mmap not in MODOS_MMAP:
+            raise Exception('Modo de mapeamento inválido: ' + str(modo_mmap))
+
+        buffer = bytearray() if compartilhar_buffer else None
+        with Imagem.abrir(caminho, 'rb') as arquivo:
+            indice = 0
+            while True:
+                imagem = Imagem()
+                imagem.__caminho = caminho
+                imagem.__modo_mmap = modo_mmap
+                imagem.__buffer_leitura = buffer
+
+                try:
+                    if not imagem.ler_cabecalho(arquivo):
+                        # Sem tipo: fim do arquivo
+                        if imagem.get_tipo() is None:
+                            return
+                        raise Exception(imagem.get_erro())
+
+                    imagem.__formato.read_pixels(arquivo)
+                except Exception as e:
+                    raise Exception('Imagem %d: %s' % (indice, str(e)))
+
+                buffer = imagem.__buffer_leitura
+                imagem.__buffer_leitura = None
+                indice = indice + 1
+                yield imagem
+
+    def escrever_cabecalho(self, arquivo):
+        # Escrever tipo
+        arquivo.write((self.__tipo + '\n').encode('ascii'))
+
+        # Escrever comentarios
+        if self.__comentario is not None and len(self.__comentario) > 0:
+            comentarios = self.__comentario.splitlines()
+            comentarios = ['# ' + c + '\n' for c in comentarios]
+            arquivo.write(''.join(comentarios).encode('utf-8'))
+
+        # Escrever dimensoes e maxval
+        self.__formato.write_cabecalho(arquivo)
+
+    def ler_linhas(self, arquivo, quantidade: int, pendentes: list) -> np.ndarray:
+        if self.__formato is None:
+            raise Exception()
+        return self.__formato.read_linhas(arquivo, quantidade, pendentes)
 
-            # Escrever maxval
-            self.__formato.write_maxval(arquivo)
+    def escrever_linhas(self, arquivo, linhas):
+        if self.__formato is None:
+            raise Exception()
+        self.__formato.write_linhas(arquivo, linhas)
 
-            # Escrever pixels
-            self.__formato.write_pixels(arquivo)
-            return True
-        except Exception as e:
-            self.__erro = 'Falha ao escrever arquivo.\n' + str(e)
-            return False
+    def get_bytes_linha(self) -> int:
+        if self.__formato is None:
+            raise Exception()
+        return self.__formato.get_bytes_linha()
 
     def clonar(self) -> 'Imagem':
+        """
+        Copia a imagem em tempo constante: os pixels so sao copiados na primeira alteracao de um
+        dos dois lados.
+        Numa imagem em tiles o clone decodifica os tiles da mesma origem e recebe uma copia, em
+        disco, do rascunho.
+        """
         clone = Imagem()
         if self.__formato is None:
             return clone
 
+        if self.__tiles is not None:
+            clone.__tiles = self.__tiles.clonar()
+        else:
+            self.__carregar_pendentes()
         clone.__altura = self.__altura
         clone.__largura = self.__largura
         clone.__caminho = self.__caminho
         clone.__tipo = self.__tipo
         clone.__comentario = self.__comentario
         clone.__erro = self.__erro
+        clone.__piramide = self.__piramide
+        clone.__integrais = dict(self.__integrais)
         clone.__formato = self.__formato.clonar(clone)
+        if self in Imagem.__mapeadas:
+            Imagem.__mapeadas.add(clone)
         return clone
 
-    def pre_processar_linha(self, arquivo) -> str or None:
-        (linha, comentario) = Imagem.get_linha(arquivo)
-        if comentario is not None:
-            if len(self.__comentario) == 0:
-                self.__comentario = comentario
-            else:
-                self.__comentario = self.__comentario + '\n' + comentario
+    @staticmethod
+    def desvincular_arquivo(caminho: str):
+        """
+        Copia para a memoria os pixels de todas as imagens que mapeiam o arquivo `caminho`, para
+        que ele possa ser sobrescrito.
+        """
+        if not os.path.exists(caminho):
+            return
+        for imagem in list(Imagem.__mapeadas):
+            imagem.__desvincular(caminho)
+
+    def __desvincular(self, caminho: str):
+        if self.__formato is None:
+            Imagem.__mapeadas.discard(self)
+            return
 
-            if len(linha) != 0:
-                return linha
+        # Imagens em tiles copiam para o rascunho os tiles que so existem no arquivo
+        if self.__tiles is not None:
+            pixels = None
+            mapeado = self.__tiles.get_arquivo_origem()
+        else:
+            pixels = self.__formato.get_matriz()
+            mapeado = Imagem.get_arquivo_mapeado(pixels)
+        if mapeado is None:
+            Imagem.__mapeadas.discard(self)
+        elif not os.path.exists(mapeado) or os.path.samefile(caminho, mapeado):
+            if self.__tiles is not None:
+                self.__tiles.desvincular()
             else:
-                return self.pre_processar_linha(arquivo)
+                self.__formato.set_matriz(np.copy(pixels))
+            Imagem.__mapeadas.discard(self)
+
+    @staticmethod
+    def get_arquivo_mapeado(pixels) -> str or None:
+        """
+        Caminho do arquivo mapeado por um array (ou pela base dele), se houver.
+        """
+        while isinstance(pixels, np.ndarray):
+            if isinstance(pixels, np.memmap) and pixels.filename is not None:
+                return pixels.filename
+            pixels = pixels.base
+        return None
+
+    def adicionar_comentario(self, comentario: str):
+        if len(self.__comentario) == 0:
+            self.__comentario = comentario
         else:
-            return linha
+            self.__comentario = self.__comentario + '\n' + comentario
+
+    def pre_processar_token(self, arquivo) -> str or None:
+        """
+        Le o proximo token do cabecalho, guardando os comentarios encontrados.
+        Consome exatamente um caractere de espaco apos o token, como exigido
+        antes do inicio dos pixels nos formatos binarios.
+        """
+        token = b''
+        while True:
+            c = arquivo.read(1)
+            if not c:
+                break
+            if c == b'#':
+                comentario = arquivo.readline().decode('utf-8', 'replace').strip()
+                if len(comentario) > 0:
+                    self.adicionar_comentario(comentario)
+                if len(token) > 0:
+                    break
+            elif c.isspace():
+                if len(token) > 0:
+                    break
+            else:
+                token = token + c
 
-    def pre_processar_resto(self, arquivo) -> str:
-        resto = ''
+        if len(token) == 0:
+            return None
+        return token.decode('ascii')
+
+    def pre_processar_linha(self, arquivo) -> str or None:
+        # Linhas que contem apenas comentario sao puladas
         while True:
+            (linha, comentario) = Imagem.get_linha(arquivo)
+            if comentario is None:
+                return linha
+
+            self.adicionar_comentario(comentario)
+            if len(linha) != 0:
+                return linha
+
+    def pre_processar_amostras(self, arquivo, quantidade: int, pendentes: list, bits: bool = False) -> list:
+        """
+        Le linha a linha ate juntar `quantidade` amostras plain-text. As amostras lidas a mais
+        ficam em `pendentes` para a proxima chamada.
+        """
+        while len(pendentes) < quantidade:
             linha = self.pre_processar_linha(arquivo)
-            if linha is not None:
-                resto = resto + ' ' + linha
+            if linha is None:
+                raise Exception('Arquivo incompleto: faltam amostras de pixels.')
+            if bits:
+                pendentes.extend(c for c in linha if not c.isspace())
             else:
-                break
-        return resto.strip()
+                pendentes.extend(linha.split())
+
+        amostras = pendentes[:quantidade]
+        del pendentes[:quantidade]
+        return amostras
+
+    def pre_processar_resto(self, arquivo) -> bytes:
+        """
+        Le todo o restante do arquivo de uma vez e remove os comentarios numa unica passada,
+        guardando-os no comentario da imagem.
+        """
+        resto, comentarios = Imagem.remover_comentarios(arquivo.read())
+        for comentario in comentarios:
+            self.adicionar_comentario(comentario)
+        return resto
+
+    @staticmethod
+    def remover_comentarios(dados: bytes) -> (bytes, list):
+        """
+        Remove os comentarios de um trecho de pixels plain-text, retornando-os a parte.
+        """
+        if b'#' not in dados:
+            return dados, []
+
+        partes = RE_COMENTARIO.split(dados)
+        comentarios = [c.decode('utf-8', 'replace').strip() for c in partes[1::2]]
+        return b' '.join(partes[::2]), [c for c in comentarios if len(c) > 0]
+
+    def ler_resto(self, arquivo, quantidade: int, maxval: int) -> np.ndarray:
+        """
+        Le as `quantidade` amostras plain-text restantes direto para um array do tipo compacto de
+        maxval.
+
+        Meta de desempenho: ao menos 50 MB/s de texto em um unico nucleo
+        (uma imagem P3 de 4000x3000 tem cerca de 130 MB).
+        """
+        if self.__processos > 1 and not Imagem.get_comprimido(arquivo):
+            blocos = self.get_blocos_paralelos(arquivo)
+            if len(blocos) > 1:
+                return self.ler_resto_paralelo(arquivo, blocos, quantidade, maxval)
+
+        pixels = Imagem.converter_plain(self.pre_processar_resto(arquivo), maxval)
+        if len(pixels) != quantidade:
+            raise Exception('Esperadas %d amostras, encontradas %d.' % (quantidade, len(pixels)))
+        return pixels
+
+    @staticmethod
+    def converter_plain(texto: bytes, maxval: int) -> np.ndarray:
+        with warnings.catch_warnings():
+            # Texto que nao e numero interrompe a leitura com um aviso; tratar como erro
+            warnings.simplefilter('error', DeprecationWarning)
+            # Lidas num tipo largo: no tipo compacto, valores fora do intervalo dariam a volta
+            amostras = np.fromstring(texto, dtype=np.int64, sep=' ')
+        return Imagem.estreitar_amostras(amostras, maxval)
+
+    @staticmethod
+    def estreitar_amostras(amostras: np.ndarray, maxval: int) -> np.ndarray:
+        """
+        Converte amostras lidas num tipo largo para o tipo compacto de maxval.
+        """
+        if amostras.size > 0 and (amostras.min() < 0 or amostras.max() > maxval):
+            raise Exception('Amostra fora do intervalo [0, %d].' % maxval)
+        return amostras.astype(Imagem.get_dtype(maxval))
+
+    def get_blocos_paralelos(self, arquivo) -> list:
+        """
+        Divide os pixels plain-text restantes em blocos (caminho, inicio, fim) para a leitura
+        paralela. Os blocos comecam logo apos uma quebra de linha: como um comentario vai so ate o
+        fim da linha, nenhum comentario ou amostra fica dividido entre dois blocos.
+        """
+        if 'fork' not in multiprocessing.get_all_start_methods():
+            return []
+
+        inicio = arquivo.tell()
+        fim = arquivo.seek(0, 2)
+        arquivo.seek(inicio)
+
+        quantidade = min(self.__processos * BLOCOS_POR_PROCESSO, (fim - inicio) // TAMANHO_BLOCO_PARALELO)
+        if quantidade < 2:
+            return []
+
+        limites = [inicio]
+        with mmap.mmap(arquivo.fileno(), 0, access=mmap.ACCESS_READ) as mapa:
+            for i in range(1, quantidade):
+                posicao = mapa.find(b'\n', max(inicio + (fim - inicio) * i // quantidade, limites[-1]))
+                if posicao < 0:
+                    break
+                limites.append(posicao + 1)
+        limites.append(fim)
+        return [(self.__caminho, a, b) for a, b in zip(limites[:-1], limites[1:]) if b > a]
+
+    def ler_resto_paralelo(self, arquivo, blocos: list, quantidade: int, maxval: int) -> np.ndarray:
+        """
+        Como ler_resto, mas com os blocos convertidos por varios processos. Uma primeira passada
+        conta as amostras de cada bloco; na segunda, cada processo escreve as suas direto na
+        posicao final de um array em memoria compartilhada (mmap anonimo herdado pelo fork).
+        """
+        dtype = Imagem.get_dtype(maxval)
+        saida = mmap.mmap(-1, max(quantidade * dtype.itemsize, 1))
+        contexto = multiprocessing.get_context('fork')
+        with contexto.Pool(self.__processos, Imagem.iniciar_processo_paralelo, (saida,)) as pool:
+            contagens = pool.starmap(Imagem.contar_bloco_plain, blocos)
+
+            total = sum(c for c, _ in contagens)
+            if total != quantidade:
+                raise Exception('Esperadas %d amostras, encontradas %d.' % (quantidade, total))
+            for _, comentarios in contagens:
+                for comentario in comentarios:
+                    self.adicionar_comentario(comentario)
+
+            posicoes = np.cumsum([0] + [c for c, _ in contagens[:-1]])
+            pool.starmap(Imagem.ler_bloco_plain, [bloco + (int(posicao), contagem, maxval)
+                                                  for bloco, posicao, (contagem, _)
+                                                  in zip(blocos, posicoes, contagens)])
+
+        arquivo.seek(blocos[-1][2])
+        return np.frombuffer(saida, dtype=dtype, count=quantidade)
+
+    # Array de saida da leitura paralela, visto pelos processos filhos
+    saida_paralela = None
+
+    @staticmethod
+    def iniciar_processo_paralelo(saida):
+        Imagem.saida_paralela = saida
+
+    @staticmethod
+    def ler_bloco_bytes(caminho: str, inicio: int, fim: int) -> bytes:
+        with open(caminho, 'rb') as arquivo:
+            arquivo.seek(inicio)
+            return arquivo.read(fim - inicio)
+
+    @staticmethod
+    def contar_bloco_plain(caminho: str, inicio: int, fim: int) -> (int, list):
+        """
+        Conta as amostras (sequencias de caracteres que nao sao espaco) de um bloco plain-text.
+        """
+        texto, comentarios = Imagem.remover_comentarios(Imagem.ler_bloco_bytes(caminho, inicio, fim))
+        espacos = ESPACOS[np.frombuffer(texto, dtype=np.uint8)]
+        if len(espacos) == 0:
+            return 0, comentarios
+        return int(np.count_nonzero(espacos[:-1] & ~espacos[1:])) + int(not espacos[0]), comentarios
+
+    @staticmethod
+    def ler_bloco_plain(caminho: str, inicio: int, fim: int, posicao: int, quantidade: int, maxval: int):
+        texto, _ = Imagem.remover_comentarios(Imagem.ler_bloco_bytes(caminho, inicio, fim))
+        pixels = Imagem.converter_plain(texto, maxval)
+        if len(pixels) != quantidade:
+            raise Exception('Esperadas %d amostras no bloco, encontradas %d.' % (quantidade, len(pixels)))
+        destino = np.frombuffer(Imagem.saida_paralela, dtype=pixels.dtype, count=quantidade,
+                                offset=posicao * pixels.itemsize)
+        destino[:] = pixels
+
+    def ler_resto_bits(self, arquivo, quantidade: int) -> np.ndarray:
+        """
+        Le os bits de um P1, que podem estar separados por espacos ou nao.
+        """
+        resto = np.frombuffer(self.pre_processar_resto(arquivo), dtype=np.uint8)
+        bits = (resto == ord('0')) | (resto == ord('1'))
+        espacos = np.isin(resto, np.frombuffer(b' \t\r\n\v\f', dtype=np.uint8))
+        if not np.all(bits | espacos):
+            raise Exception('Caractere inválido nos pixels de uma imagem PBM.')
+
+        pixels = resto[bits] - ord('0')
+        if len(pixels) != quantidade:
+            raise Exception('Esperadas %d amostras, encontradas %d.' % (quantidade, len(pixels)))
+        return pixels
 
     @staticmethod
     def get_linha(arquivo) -> (str, str or None):
         linha = arquivo.readline()
         if not linha:
             return None, None
-        elif '#' in linha:
+        if isinstance(linha, bytes):
+            linha = linha.decode('utf-8', 'replace')
+        if '#' in linha:
             indice = linha.index('#')
             comentario = linha[indice + 1:].strip()
             linha = linha[:indice].strip()
@@ -519,6 +2011,190 @@ class Imagem:
         else:
             return linha.strip(), None
 
+    @staticmethod
+    def abrir(caminho: str, modo: str):
+        """
+        Abre um arquivo de imagem para leitura ('rb') ou escrita ('wb'), comprimido ou nao.
+        Na leitura a compressao e detectada pela assinatura do arquivo; na escrita, pela extensao
+        (.gz, .bz2 ou .xz). Os dados sao (des)comprimidos em blocos conforme sao lidos ou escritos,
+        sem arquivos temporarios.
+        """
+        if modo == 'rb':
+            arquivo = open(caminho, 'rb', buffering=TAMANHO_BUFFER)
+            inicio = arquivo.peek(8)[:8]
+            for _, assinatura, modulo in COMPRESSOES:
+                if inicio.startswith(assinatura):
+                    # Aberto pelo caminho para que fechar o descompressor feche tambem o arquivo
+                    arquivo.close()
+                    return modulo.open(caminho, 'rb')
+            return arquivo
+
+        _, compressao = Imagem.separar_compressao(caminho)
+        for extensao, _, modulo in COMPRESSOES:
+            if compressao == extensao:
+                return modulo.open(caminho, modo)
+        return open(caminho, modo, buffering=TAMANHO_BUFFER)
+
+    @staticmethod
+    def separar_compressao(caminho: str) -> (str, str):
+        """
+        Separa a extensao de compressao do caminho: 'a.pgm.gz' -> ('a.pgm', '.gz').
+        """
+        for extensao, _, _ in COMPRESSOES:
+            if caminho.lower().endswith(extensao):
+                return caminho[:-len(extensao)], extensao
+        return caminho, ''
+
+    @staticmethod
+    def get_comprimido(arquivo) -> bool:
+        return isinstance(arquivo, (gzip.GzipFile, bz2.BZ2File, lzma.LZMAFile))
+
+    def pre_processar_bruto(self, arquivo, quantidade: int, maxval: int, mapear: bool = True) -> np.ndarray:
+        """
+        Le `quantidade` amostras binarias: mapeadas do arquivo, se houver modo de mmap, ou lidas
+        para o buffer compartilhado, se houver, ou para um buffer novo.
+        Arquivos comprimidos nao podem ser mapeados e sao sempre lidos para a memoria.
+        """
+        if mapear and self.__modo_mmap is not None and not Imagem.get_comprimido(arquivo):
+            Imagem.__mapeadas.add(self)
+            return Imagem.mapear_bruto(arquivo, quantidade, maxval, self.__modo_mmap)
+
+        if self.__buffer_leitura is not None:
+            tamanho = quantidade * Imagem.get_dtype_bruto(maxval).itemsize
+            if len(self.__buffer_leitura) < tamanho:
+                # Pixels de imagens anteriores podem estar usando o buffer: trocar por um maior
+                self.__buffer_leitura = bytearray(tamanho)
+        return Imagem.ler_bruto(arquivo, quantidade, maxval, self.__buffer_leitura)
+
+    @staticmethod
+    def get_dtype(maxval: int) -> np.dtype:
+        """
+        Menor tipo inteiro que comporta as amostras: 1 byte ate 255, 2 bytes ate 65535.
+        """
+        if maxval < 256:
+            return np.dtype(np.uint8)
+        return np.dtype(np.uint16)
+
+    @staticmethod
+    def saturar(pixels, maxval: int) -> np.ndarray:
+        """
+        Converte os pixels para o tipo compacto de maxval, arredondando e limitando os valores
+        ao intervalo [0, maxval]. Os calculos devem ser feitos num tipo mais largo e saturados
+        aqui apenas no final. Arrays que ja estao no tipo compacto sao mantidos sem copia.
+        """
+        dtype = Imagem.get_dtype(maxval)
+        pixels = np.asarray(pixels)
+        if pixels.dtype.kind == 'u' and pixels.dtype.itemsize == dtype.itemsize:
+            return pixels
+
+        if pixels.dtype.kind == 'f':
+            pixels = np.rint(pixels)
+        return np.clip(pixels, 0, maxval).astype(dtype)
+
+    @staticmethod
+    def get_dtype_bruto(maxval: int) -> np.dtype:
+        # Amostras com maxval acima de 255 ocupam 2 bytes, big-endian
+        if maxval < 256:
+            return np.dtype(np.uint8)
+        return np.dtype('>u2')
+
+    @staticmethod
+    def ler_bruto(arquivo, quantidade: int, maxval: int, buffer: bytearray = None) -> np.ndarray:
+        """
+        Le `quantidade` amostras binarias com uma unica leitura, sem copias intermediarias.
+        Se `buffer` for informado, os dados sao lidos no seu inicio, que deve ter espaco suficiente.
+        """
+        dtype = Imagem.get_dtype_bruto(maxval)
+        tamanho = quantidade * dtype.itemsize
+        dados = bytearray(tamanho) if buffer is None else buffer
+        visao = memoryview(dados)
+        lidos = 0
+        while lidos < tamanho:
+            n = arquivo.readinto(visao[lidos:tamanho])
+            if not n:
+                raise Exception('Arquivo incompleto: esperados %d bytes de pixels, encontrados %d.'
+                                % (tamanho, lidos))
+            lidos = lidos + n
+        return np.frombuffer(dados, dtype=dtype, count=quantidade)
+
+    @staticmethod
+    def mapear_bruto(arquivo, quantidade: int, maxval: int, modo: str) -> np.memmap:
+        """
+        Mapeia `quantidade` amostras binarias a partir da posicao atual do arquivo.
+        Nenhum pixel e lido: as paginas sao carregadas pelo sistema conforme forem acessadas.
+        """
+        dtype = Imagem.get_dtype_bruto(maxval)
+        inicio = arquivo.tell()
+        tamanho = quantidade * dtype.itemsize
+        disponivel = arquivo.seek(0, 2) - inicio
+        if disponivel < tamanho:
+            raise Exception('Arquivo incompleto: esperados %d bytes de pixels, encontrados %d.'
+                            % (tamanho, disponivel))
+        # O np.memmap deixa o arquivo no fim: posicionar depois, para a proxima imagem do arquivo
+        pixels = np.memmap(arquivo, dtype=dtype, mode=modo, offset=inicio, shape=(quantidade,))
+        arquivo.seek(inicio + tamanho)
+        return pixels
+
+    @staticmethod
+    def escrever_bruto(arquivo, pixels, maxval: int):
+        dtype = Imagem.get_dtype_bruto(maxval)
+        pixels = np.asarray(pixels)
+        if pixels.dtype != dtype:
+            pixels = np.clip(pixels, 0, maxval).astype(dtype)
+        arquivo.write(np.ascontiguousarray(pixels).data)
+
+    @staticmethod
+    @functools.lru_cache(maxsize=8)
+    def get_tabela_plain(maxval: int) -> (np.ndarray, np.ndarray):
+        """
+        Tabela com o texto de cada valor de 0 a maxval seguido de um espaco, preenchida com zeros
+        ate a largura do maior valor, e o tamanho de cada texto (sem o espaco).
+        """
+        valores = np.arange(maxval + 1)
+        digitos = len(str(maxval))
+
+        tamanhos = np.ones(maxval + 1, dtype=np.intp)
+        for i in range(1, digitos):
+            tamanhos = tamanhos + (valores >= 10 ** i)
+
+        tabela = np.zeros((maxval + 1, digitos + 1), dtype=np.uint8)
+        for i in range(digitos):
+            expoente = tamanhos - 1 - i
+            validos = expoente >= 0
+            tabela[validos, i] = ord('0') + (valores[validos] // (10 ** expoente[validos])) % 10
+        tabela[valores, tamanhos] = ord(' ')
+        return tabela, tamanhos
+
+    @staticmethod
+    def escrever_plain(arquivo, pixels, maxval: int, canais: int = 1):
+        """
+        Escreve as amostras em texto, em blocos grandes e sem formatar pixel a pixel em Python.
+        Cada linha tem o maximo de pixels inteiros que cabem em LIMITE_LINHA caracteres.
+        """
+        tabela, tamanhos = Imagem.get_tabela_plain(maxval)
+        por_linha = max(1, (LIMITE_LINHA // tabela.shape[1]) // canais) * canais
+
+        amostras = np.ravel(pixels)
+        if amostras.dtype.kind not in 'ui' or amostras.min(initial=0) < 0 or amostras.max(initial=0) > maxval:
+            amostras = np.clip(amostras, 0, maxval).astype(np.intp)
+
+        # Blocos com um numero inteiro de linhas, para que as quebras continuem de um bloco para o outro
+        bloco = max(1, AMOSTRAS_POR_BLOCO // por_linha) * por_linha
+        largura = tabela.shape[1]
+        textos = tabela.view('V%d' % largura).ravel()
+        for inicio in range(0, len(amostras), bloco):
+            # Cada linha da tabela vista como um unico elemento: a busca copia o texto inteiro de uma vez
+            valores = amostras[inicio:inicio + bloco]
+            texto = textos.take(valores).view(np.uint8).reshape(len(valores), largura)
+
+            # Trocar o espaco do ultimo valor de cada linha por uma quebra de linha
+            fins = np.arange(por_linha - 1, len(valores), por_linha)
+            if len(valores) % por_linha != 0:
+                fins = np.append(fins, len(valores) - 1)
+            texto[fins, tamanhos[valores[fins]]] = ord('\n')
+
+            arquivo.write(texto[texto != 0].tobytes())
+
     @staticmethod
     def get_cor_255(cor, maxval) -> int:
         # res    cor
@@ -537,73 +2213,297 @@ class Imagem:
         # res = (cor * maxval) / 255
         return round((cor * maxval) / 255.0)
 
+    @staticmethod
+    def get_cores_255(cores, maxval: int) -> np.ndarray:
+        """
+        get_cor_255 para um array inteiro, com o mesmo arredondamento.
+        """
+        cores = np.asarray(cores)
+        if maxval == 255:
+            return cores.astype(np.uint8)
+        return np.rint((cores * 255.0) / maxval).astype(np.uint8)
+
+    @staticmethod
+    def get_cores_maxval(cores, maxval: int) -> np.ndarray:
+        """
+        get_cor_maxval para um array inteiro, saturado no tipo compacto de maxval.
+        """
+        cores = np.asarray(cores)
+        if maxval == 255:
+            return Imagem.saturar(cores, maxval)
+        return Imagem.saturar((cores * float(maxval)) / 255.0, maxval)
+
+
+class Imagens:
+    """
+        Colecao de imagens, p.ex. os quadros de um arquivo com varias imagens concatenadas.
+    """
+    def __init__(self, imagens: list = None):
+        self.__imagens = [] if imagens is None else list(imagens)
+        self.__erro = ''
+
+    def get_imagens(self) -> list:
+        return self.__imagens
+
+    def adicionar(self, imagem: Imagem):
+        self.__imagens.append(imagem)
+
+    def get_erro(self) -> str:
+        return self.__erro
+
+    def carregar(self, caminho: str, modo_mmap: str or None = None) -> bool:
+        try:
+            self.__imagens = list(Imagem.iterar(caminho, modo_mmap))
+            self.__erro = None
+            return True
+        except Exception as e:
+            self.__imagens = []
+            self.__erro = 'Falha ao carregar arquivo.\n' + str(e)
+            return False
+
+    def salvar(self, caminho: str) -> bool:
+        """
+        Salva todas as imagens, concatenadas, em um unico arquivo. Como os pixels plain-text vao
+        ate o fim do arquivo, apenas a ultima imagem pode ser plain-text.
+        """
+        try:
+            for imagem in self.__imagens[:-1]:
+                if not imagem.get_bruto():
+                    raise Exception('Apenas a última imagem pode ser plain-text.')
+
+            Imagem.desvincular_arquivo(caminho)
+            with Imagem.abrir(caminho, 'wb') as arquivo:
+                for imagem in self.__imagens:
+                    imagem.escrever(arquivo)
+            return True
+        except Exception as e:
+            self.__erro = 'Falha ao escrever arquivo.\n' + str(e)
+            return False
+
+    def processar(self, processamento, params=None) -> 'Imagens':
+        """
+        Aplica um Processamento a uma copia de cada imagem.
+        """
+        return Imagens([processamento.processar(imagem.clonar(), params) for imagem in self.__imagens])
+
+    def __len__(self):
+        return len(self.__imagens)
+
+    def __getitem__(self, indice) -> Imagem:
+        return self.__imagens[indice]
+
+    def __iter__(self):
+        return iter(self.__imagens)
+
+
+class LeitorLinhas:
+    """
+        Le os pixels de uma imagem em blocos de linhas, sem manter a imagem inteira na memoria.
+        Cada bloco tem o formato (linhas, largura), ou (linhas, largura, 3) no PPM.
+
+        Exemplo, limiarizar uma imagem maior que a memoria:
+            with LeitorLinhas('entrada.pgm') as leitor:
+                modelo = leitor.get_imagem().clonar()
+                modelo.set_tipo('P4')
+                with EscritorLinhas('saida.pbm', modelo) as escritor:
+                    for linhas in leitor:
+                        escritor.escrever(linhas > 127)
+    """
+    def __init__(self, caminho: str, linhas_por_bloco: int = 64):
+        self.__imagem = Imagem()
+        self.__linhas_por_bloco = linhas_por_bloco
+        self.__linha_atual = 0
+        self.__pendentes = []
+
+        self.__arquivo = Imagem.abrir(caminho, 'rb')
+        try:
+            if not self.__imagem.ler_cabecalho(self.__arquivo):
+                raise Exception(self.__imagem.get_erro())
+        except Exception:
+            self.__arquivo.close()
+            raise
+        self.__inicio_pixels = self.__arquivo.tell()
+
+    def get_imagem(self) -> Imagem:
+        """
+        Imagem apenas com o cabecalho (tipo, dimensoes, maxval e comentarios), sem pixels.
+        """
+        return self.__imagem
+
+    def get_linha_atual(self) -> int:
+        return self.__linha_atual
+
+    def ler(self, quantidade: int = None) -> np.ndarray or None:
+        """
+        Le as proximas `quantidade` linhas, ou None ao fim da imagem.
+        """
+        if quantidade is None:
+            quantidade = self.__linhas_por_bloco
+        quantidade = min(quantidade, self.__imagem.get_altura() - self.__linha_atual)
+        if quantidade <= 0:
+            return None
+
+        linhas = self.__imagem.ler_linhas(self.__arquivo, quantidade, self.__pendentes)
+        self.__linha_atual = self.__linha_atual + quantidade
+        return linhas
+
+    def posicionar(self, linha: int):
+        """
+        Pula direto para `linha`, pelo seu offset em bytes. Apenas para os formatos binarios;
+        nos plain-text so e possivel avancar ate a linha, lendo as anteriores.
+        """
+        if self.__imagem.get_bruto():
+            self.__arquivo.seek(self.__inicio_pixels + linha * self.__imagem.get_bytes_linha())
+            self.__linha_atual = linha
+            return
+
+        if linha < self.__linha_atual:
+            raise Exception('Imagens plain-text so podem ser lidas para frente.')
+        while self.__linha_atual < linha:
+            self.ler(min(self.__linhas_por_bloco, linha - self.__linha_atual))
+
+    def fechar(self):
+        self.__arquivo.close()
+
+    def __iter__(self):
+        while True:
+            linhas = self.ler()
+            if linhas is None:
+                return
+            yield linhas
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.fechar()
+
+
+class EscritorLinhas:
+    """
+        Escreve uma imagem em blocos de linhas. O cabecalho (tipo, dimensoes, maxval e
+        comentarios) vem da imagem `modelo`, que nao precisa ter pixels.
+    """
+    def __init__(self, caminho: str, modelo: Imagem):
+        self.__imagem = modelo
+        self.__linhas_escritas = 0
+
+        self.__arquivo = Imagem.abrir(caminho, 'wb')
+        try:
+            self.__imagem.escrever_cabecalho(self.__arquivo)
+        except Exception:
+            self.__arquivo.close()
+            raise
+
+    def get_linhas_escritas(self) -> int:
+        return self.__linhas_escritas
+
+    def escrever(self, linhas):
+        """
+        :param linhas: array (linhas, largura) ou (linhas, largura, 3)
+        """
+        linhas = np.asarray(linhas)
+        canais = self.__imagem.get_canais()
+        quantidade = linhas.size // (self.__imagem.get_largura() * canais)
+        if self.__linhas_escritas + quantidade > self.__imagem.get_altura():
+            raise Exception('Linhas além da altura da imagem.')
+
+        self.__imagem.escrever_linhas(self.__arquivo, linhas)
+        self.__linhas_escritas = self.__linhas_escritas + quantidade
+
+    def fechar(self):
+        self.__arquivo.close()
+        if self.__linhas_escritas != self.__imagem.get_altura():
+            raise Exception('Imagem incompleta: %d de %d linhas escritas.'
+                            % (self.__linhas_escritas, self.__imagem.get_altura()))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, tipo, valor, traceback):
+        if tipo is None:
+            self.fechar()
+        else:
+            self.__arquivo.close()
+
+
+def get_cinza(imagem: Imagem, luminancia: str = 'media') -> np.ndarray:
+    """
+    Matriz (altura, largura) em tons de cinza, na escala 0..maxval da imagem (float para cores).
+    Canais de opacidade (PAM) sao ignorados.
+
+    :param luminancia: 'media' (media simples dos canais), 'bt601' ou 'bt709'
+    """
+    if luminancia not in LUMINANCIAS:
+        raise Exception('Luminância inválida: ' + str(luminancia))
+
+    matriz = imagem.get_matriz()
+    if matriz.ndim == 2:
+        return matriz
+    if matriz.shape[2] < 3:
+        return matriz[:, :, 0]
+
+    rgb = matriz[:, :, :3]
+    pesos = LUMINANCIAS[luminancia]
+    if pesos is None:
+        return rgb.sum(axis=2, dtype=np.uint32) / 3.0
+    return np.dot(rgb, np.asarray(pesos))
+
 
 def converter_ppm(imagem: Imagem) -> Imagem:
-    if imagem.get_tipo() == 'P3':
+    if imagem.get_tipo_plain() == 'P3':
         return imagem.clonar()
 
-    atualizar_maxval = imagem.get_maxval() == 1
-
     clone = imagem.clonar()
-    clone.set_tipo('P3')
+    clone.set_tipo_plain('P3')
 
-    pixels = []
-    if not atualizar_maxval:
-        clone.set_maxval(imagem.get_maxval())
-        for p in imagem.get_pixels():
-            pixels.append([p, p, p])
+    if imagem.get_binario():
+        # 1 vira branco, como em get_pixel
+        matriz = imagem.get_matriz() * np.uint8(clone.get_maxval())
     else:
-        maxval = clone.get_maxval()
-        for p in imagem.get_pixels():
-            v = p * maxval
-            pixels.append([v, v, v])
+        clone.set_maxval(imagem.get_maxval())
+        matriz = imagem.get_matriz()
+        if matriz.ndim == 3 and matriz.shape[2] >= 3:
+            matriz = matriz[:, :, :3]
+        else:
+            matriz = get_cinza(imagem)
 
-    clone.set_pixels(np.array(pixels))
+    if matriz.ndim == 2:
+        matriz = np.repeat(matriz[:, :, np.newaxis], 3, axis=2)
+    clone.set_matriz(matriz)
     return clone
 
 
-def converter_pgm(imagem: Imagem) -> Imagem:
-    if imagem.get_tipo() == 'P2':
+def converter_pgm(imagem: Imagem, luminancia: str = 'media') -> Imagem:
+    """
+    :param luminancia: como as cores viram cinza; veja get_cinza
+    """
+    if imagem.get_tipo_plain() == 'P2':
         return imagem.clonar()
 
     clone = imagem.clonar()
-    clone.set_tipo('P2')
+    clone.set_tipo_plain('P2')
 
-    pixels = []
-    if imagem.get_tipo() == 'P3':
-        clone.set_maxval(imagem.get_maxval())
-        for p in imagem.get_pixels():
-            v = 0
-            for c in p:
-                v = v + c
-            v = v / len(p)
-            pixels.append(v)
+    if imagem.get_binario():
+        matriz = imagem.get_matriz() * np.uint8(clone.get_maxval())
     else:
-        maxval = clone.get_maxval()
-        for p in imagem.get_pixels():
-            v = p * maxval
-            pixels.append(v)
+        clone.set_maxval(imagem.get_maxval())
+        matriz = get_cinza(imagem, luminancia)
 
-    clone.set_pixels(np.array(pixels))
+    clone.set_matriz(matriz)
     return clone
 
 
 def converter_pbm(imagem: Imagem) -> Imagem:
-    if imagem.get_tipo() == 'P1':
+    """
+    Pixels diferentes de 0 (depois da conversao para cinza, se coloridos) viram 1.
+    """
+    if imagem.get_tipo_plain() == 'P1':
         return imagem.clonar()
 
-    if imagem.get_tipo() == 'P3':
-        clone = converter_pgm(imagem)
-    else:
-        clone = imagem.clonar()
-    clone.set_tipo('P1')
+    matriz = Imagem.saturar(get_cinza(imagem), imagem.get_maxval()) != 0
 
-    pixels = []
-    for p in imagem.get_pixels():
-        if p == 0:
-            pixels.append(0)
-        else:
-            pixels.append(1)
-
-    clone.set_pixels(np.array(pixels))
+    clone = imagem.clonar()
+    clone.set_tipo_plain('P1')
+    clone.set_matriz(matriz.view(np.uint8))
     return clone
@@ -5,57 +5,417 @@
     Contém os processamentos de imagem.
 """
 
+import functools
+import multiprocessing
 import numpy as np
-import math
 import random
-from imagens import Imagem, converter_ppm, converter_pgm, converter_pbm
+from imagens import Imagem, TAMANHO_TILE, converter_ppm, converter_pgm, get_cinza
 
 
-def processar_unico(imagem: Imagem, indice: int, func, params=None):
+# Linhas de saida calculadas por vez na convolucao, para limitar a memoria temporaria
+LINHAS_CONVOLUCAO = 128
+
+# Mediana por histogramas: maior valor de amostra aceito, bins por grupo da busca em dois niveis e
+# tamanho dos blocos de janelas ordenadas quando o histograma nao se aplica
+LIMITE_HISTOGRAMA = 255
+BINS_POR_GRUPO = 16
+BYTES_JANELAS = 1 << 26
+
+# Modos de borda dos filtros, que mantem o tamanho da imagem (None: a imagem perde a borda)
+BORDAS = (None, 'constante', 'replicar', 'refletir', 'repetir')
+
+
+def processar_tiles(imagem: Imagem, processamento: 'Processamento', params=None) -> Imagem:
     """
-    :param func: function(pixel: int or int[], params?)
+    Aplica processamento.processar_tile a cada tile da imagem, no lugar. Numa imagem em tiles so o
+    tile atual precisa estar na memoria.
     """
-    if not callable(func):
-        raise Exception()
+    for x, y, tile in imagem.iterar_tiles(escrita=True):
+        processamento.processar_tile(imagem, tile, params)
+    return imagem
 
-    p = imagem.get_pixels()[indice]
-    if imagem.get_tipo() == 'P3':
-        if params is not None:
-            return [func(p[0], params), func(p[1], params), func(p[2], params)]
-        else:
-            return [func(p[0]), func(p[1]), func(p[2])]
+
+@functools.lru_cache(maxsize=64)
+def get_tabela_pontual(processamento: 'ProcessamentoPontual', maxval: int, params=None) -> np.ndarray:
+    """
+    Tabela de maxval + 1 entradas com o novo valor de cada amostra, calculada uma vez por
+    (processamento, params, maxval). Os params precisam ser hashable.
+    """
+    amostras = np.arange(maxval + 1)
+    tabela = Imagem.saturar(processamento.calcular_tabela(amostras, maxval, params), maxval)
+    tabela.flags.writeable = False
+    return tabela
+
+
+def binarizar(imagem: Imagem, tabela: np.ndarray) -> Imagem:
+    """
+    Imagem PBM com o valor na tabela (0 ou 1) de cada amostra de cinza: uma indexacao pela tabela
+    e o empacotamento dos bits. Imagens com mais de um canal sao convertidas para cinza antes.
+    """
+    if imagem.get_canais() > 1:
+        imagem = converter_pgm(imagem)
+
+    clone = imagem.clonar()
+    clone.set_tipo_plain('P1')
+    clone.set_matriz(np.take(tabela, get_cinza(imagem), mode='clip'))
+    return clone
+
+
+def convoluir(pixels: np.ndarray, kernel, maxval: int) -> np.ndarray:
+    """
+    Aplica o kernel (sem inverte-lo) nas posicoes em que ele cabe inteiro na imagem. Cada elemento
+    do kernel e somado de uma vez para todos os pixels e canais, na mesma ordem do calculo pixel a
+    pixel. As somas sao truncadas para inteiro e saturadas em 0..maxval.
+
+    :param pixels: matriz (altura, largura) ou (altura, largura, canais)
+    :return: matriz (altura - 2 * ks, largura - 2 * ks) ou (altura - 2 * ks, largura - 2 * ks, canais)
+    """
+    kernel = np.asarray(kernel)
+    ks = (len(kernel) - 1) // 2
+    altura = max(pixels.shape[0] - 2 * ks, 0)
+    largura = max(pixels.shape[1] - 2 * ks, 0)
+    saida = np.empty((altura, largura) + pixels.shape[2:], dtype=Imagem.get_dtype(maxval))
+
+    # Kernels inteiros somam em inteiros, como no calculo pixel a pixel
+    tipo = np.float64 if kernel.dtype.kind == 'f' else np.int64
+    for x in range(0, altura, LINHAS_CONVOLUCAO):
+        linhas = min(LINHAS_CONVOLUCAO, altura - x)
+        soma = np.zeros((linhas, largura) + pixels.shape[2:], dtype=tipo)
+        termo = np.empty_like(soma)
+        for ki in range(len(kernel)):
+            for kj in range(len(kernel[ki])):
+                if kernel[ki, kj] != 0:
+                    np.multiply(pixels[x + ki:x + ki + linhas, kj:kj + largura], kernel[ki, kj], out=termo)
+                    soma += termo
+        saida[x:x + linhas] = Imagem.saturar(np.trunc(soma), maxval)
+    return saida
+
+
+def get_indices_borda(inicio: int, fim: int, tamanho: int, borda: str) -> np.ndarray:
+    """
+    Indice, dentro de 0..tamanho - 1, de cada posicao de inicio ate fim (exclusive), que pode
+    estar fora da imagem; -1 nas posicoes que a borda 'constante' preenche com 0.
+    """
+    indices = np.arange(inicio, fim)
+    if borda == 'constante':
+        return np.where((indices < 0) | (indices >= tamanho), -1, indices)
+    if borda == 'replicar':
+        return np.clip(indices, 0, tamanho - 1)
+    if borda == 'refletir':
+        # Espelho sem repetir o pixel da borda: ... 2 1 | 0 1 2 ... n-1 | n-2 n-3 ...
+        if tamanho == 1:
+            return np.zeros_like(indices)
+        periodo = 2 * (tamanho - 1)
+        indices = np.abs(indices) % periodo
+        return np.where(indices >= tamanho, periodo - indices, indices)
+    if borda == 'repetir':
+        return indices % tamanho
+    raise Exception('Borda inválida: ' + str(borda))
+
+
+def get_corridas(indices: np.ndarray) -> list:
+    """
+    Divide os indices validos em grupos de indices proximos, cada um lido com um unico acesso:
+    [(posicoes no resultado, indices na imagem), ...].
+    """
+    posicoes = np.nonzero(indices >= 0)[0]
+    valores = indices[posicoes]
+    quebras = np.nonzero((np.abs(np.diff(valores)) > 1) | (np.diff(posicoes) > 1))[0] + 1
+    return list(zip(np.split(posicoes, quebras), np.split(valores, quebras)))
+
+
+def ler_com_borda(imagem: Imagem, x: int, y: int, altura: int, largura: int, borda: str) -> np.ndarray:
+    """
+    Bloco de pixels (sem conversao para 0..255) a partir da linha x e coluna y, que pode sair da
+    imagem: o que fica fora e preenchido conforme a borda ('constante', 'replicar', 'refletir' ou
+    'repetir'). Le apenas as regioes da imagem usadas, entao funciona tambem com imagens em tiles.
+    """
+    linhas = get_corridas(get_indices_borda(x, x + altura, imagem.get_altura(), borda))
+    colunas = get_corridas(get_indices_borda(y, y + largura, imagem.get_largura(), borda))
+
+    amostra = imagem.get_regiao(0, 0, 1, 1, False)
+    bloco = np.zeros((altura, largura) + amostra.shape[2:], dtype=amostra.dtype)
+    for posicoes_l, indices_l in linhas:
+        for posicoes_c, indices_c in colunas:
+            x0, y0 = indices_l.min(), indices_c.min()
+            regiao = imagem.get_regiao(x0, y0, indices_l.max() - x0 + 1, indices_c.max() - y0 + 1, False)
+            bloco[np.ix_(posicoes_l, posicoes_c)] = regiao[np.ix_(indices_l - x0, indices_c - y0)]
+    return bloco
+
+
+def filtrar(imagem: Imagem, funcao, ks: int, borda: str = None, processos: int = 1) -> Imagem:
+    """
+    Aplica um filtro de vizinhanca. funcao(matriz) retorna a matriz filtrada, ks pixels menor de
+    cada lado, ja no tipo compacto de maxval.
+
+    :param borda: None para a imagem perder ks pixels de cada lado. Com 'constante', 'replicar',
+                  'refletir' ou 'repetir', a imagem e estendida pela borda e mantem o tamanho.
+    :param processos: com borda, filtrar os tiles de cada faixa em varios processos (com fork).
+                      Imagens em tiles, ou com processos > 1, sao filtradas tile a tile, cada tile
+                      lido com ks pixels a mais de cada lado; o resultado e o mesmo da imagem inteira.
+    """
+    if borda is None:
+        imagem.set_matriz(funcao(imagem.get_matriz()))
+        return imagem
+
+    altura, largura = imagem.get_altura(), imagem.get_largura()
+    if not imagem.get_em_tiles() and processos <= 1:
+        imagem.set_matriz(funcao(ler_com_borda(imagem, -ks, -ks, altura + 2 * ks, largura + 2 * ks, borda)))
+        return imagem
+
+    if ks > TAMANHO_TILE:
+        raise Exception('Kernel maior que os tiles: %d.' % (2 * ks + 1))
+    if processos > 1 and 'fork' in multiprocessing.get_all_start_methods():
+        pool = multiprocessing.get_context('fork').Pool(processos)
+        mapear = pool.map
     else:
-        if params is not None:
-            return func(p, params)
-        else:
-            return func(p)
+        pool = None
+        mapear = map
+
+    # Cada faixa de tiles e escrita so depois que a seguinte foi calculada, porque o halo dela
+    # ainda usa os pixels originais. Com 'repetir' a primeira faixa e lida de novo pela ultima.
+    pendentes = []
+    try:
+        for x in range(0, altura, TAMANHO_TILE):
+            h = min(TAMANHO_TILE, altura - x)
+            entradas = [ler_com_borda(imagem, x - ks, y - ks, h + 2 * ks, min(TAMANHO_TILE, largura - y) + 2 * ks,
+                                      borda)
+                        for y in range(0, largura, TAMANHO_TILE)]
+            faixa = np.concatenate(list(mapear(funcao, entradas)), axis=1)
+
+            if len(pendentes) > 0 and not (borda == 'repetir' and pendentes[-1][0] == 0):
+                imagem.set_regiao(*pendentes.pop(), escala_255=False)
+            pendentes.append((x, 0, faixa))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    for pendente in pendentes:
+        imagem.set_regiao(*pendente, escala_255=False)
+    return imagem
+
+
+def media_caixa(pixels: np.ndarray, tamanho: int, maxval: int) -> np.ndarray:
+    """
+    Media de cada janela tamanho x tamanho que cabe inteira na matriz, pela imagem integral:
+    quatro acessos por pixel, qualquer que seja o tamanho. Arredondada e saturada em 0..maxval.
+    """
+    integral = np.zeros((pixels.shape[0] + 1, pixels.shape[1] + 1) + pixels.shape[2:], dtype=np.int64)
+    integral[1:, 1:] = np.cumsum(np.cumsum(pixels, axis=0, dtype=np.int64), axis=1)
+    return Imagem.saturar(Imagem.somar_janelas(integral, tamanho) / float(tamanho * tamanho), maxval)
 
 
-def processar_independente(imagem: Imagem, func, params=None):
+def mediana(pixels: np.ndarray, tamanho: int) -> np.ndarray:
     """
-    :param func: function(pixel: int or int[], params?)
+    Mediana de cada janela tamanho x tamanho (tamanho impar) que cabe inteira na matriz, canal a
+    canal. Com amostras ate LIMITE_HISTOGRAMA usa histogramas deslizantes; acima disso, ordena
+    parcialmente cada janela.
     """
-    if not callable(func):
-        raise Exception()
-
-    if imagem.get_tipo() == 'P3':
-        if params is not None:
-            return np.array([
-                [func(p[0], params), func(p[1], params), func(p[2], params)] for p in imagem.get_pixels()
-            ])
-        else:
-            return np.array([
-                [func(p[0]), func(p[1]), func(p[2])] for p in imagem.get_pixels()
-            ])
+    if pixels.ndim > 2:
+        return np.stack([mediana(pixels[:, :, k], tamanho) for k in range(pixels.shape[2])], axis=2)
+    if pixels.size == 0 or pixels.max() > LIMITE_HISTOGRAMA:
+        return mediana_janelas(pixels, tamanho)
+    return mediana_histograma(pixels, tamanho)
+
+
+def mediana_histograma(pixels: np.ndarray, tamanho: int) -> np.ndarray:
+    """
+    Mediana por histogramas de coluna (Perreault e Hebert), vetorizada ao longo da linha. Cada
+    coluna guarda o histograma das `tamanho` linhas atuais e so ganha e perde um pixel por linha
+    de saida; o histograma de cada janela e a soma de `tamanho` colunas, por somas acumuladas. A
+    mediana e procurada em grupos de BINS_POR_GRUPO bins e depois dentro do grupo. O custo por
+    pixel depende apenas do maior valor da imagem, e nao do tamanho da janela.
+    """
+    altura, largura = pixels.shape
+    t = tamanho
+    altura_saida, largura_saida = altura - t + 1, largura - t + 1
+    saida = np.empty((max(altura_saida, 0), max(largura_saida, 0)), dtype=pixels.dtype)
+    if altura_saida <= 0 or largura_saida <= 0:
+        return saida
+
+    grupos = (int(pixels.max()) + BINS_POR_GRUPO) // BINS_POR_GRUPO
+    posicao = t * t // 2 + 1
+
+    # As somas acumuladas podem estourar o tipo, mas as diferencas entre elas (contagens de uma
+    # janela, ate t * t) saem certas na aritmetica modular
+    tipo = np.int16 if t * t <= np.iinfo(np.int16).max else np.int32
+    colunas = np.zeros((grupos * BINS_POR_GRUPO, largura), dtype=tipo)
+    acumulado = np.zeros((grupos * BINS_POR_GRUPO, largura + 1), dtype=tipo)
+    janelas = np.empty((grupos * BINS_POR_GRUPO, largura_saida), dtype=tipo)
+    indices = np.arange(largura)
+    indices_saida = np.arange(largura_saida)
+
+    for x in range(t - 1):
+        colunas[pixels[x], indices] += 1
+    for x in range(altura_saida):
+        colunas[pixels[x + t - 1], indices] += 1
+        np.cumsum(colunas, axis=1, out=acumulado[:, 1:])
+        np.subtract(acumulado[:, t:], acumulado[:, :-t], out=janelas)
+
+        # Grupo da mediana: o primeiro em que a contagem acumulada chega a `posicao`
+        por_grupo = janelas.reshape(grupos, BINS_POR_GRUPO, largura_saida)
+        contagem = np.cumsum(por_grupo.sum(axis=1), axis=0)
+        grupo = (contagem < posicao).sum(axis=0)
+        antes = np.where(grupo > 0, contagem[np.maximum(grupo - 1, 0), indices_saida], 0)
+
+        # Bin da mediana dentro do grupo
+        bins = np.cumsum(por_grupo[grupo, :, indices_saida], axis=1) + antes[:, np.newaxis]
+        saida[x] = grupo * BINS_POR_GRUPO + (bins < posicao).sum(axis=1)
+
+        colunas[pixels[x], indices] -= 1
+    return saida
+
+
+def mediana_janelas(pixels: np.ndarray, tamanho: int) -> np.ndarray:
+    """
+    Mediana ordenando parcialmente cada janela, em blocos de linhas de ate BYTES_JANELAS bytes.
+    Para amostras grandes demais para histogramas (maxval acima de LIMITE_HISTOGRAMA).
+    """
+    t = tamanho
+    altura, largura = pixels.shape
+    if altura < t or largura < t:
+        return np.empty((max(altura - t + 1, 0), max(largura - t + 1, 0)), dtype=pixels.dtype)
+
+    janelas = np.lib.stride_tricks.sliding_window_view(pixels, (t, t))
+    saida = np.empty(janelas.shape[:2], dtype=pixels.dtype)
+    posicao = t * t // 2
+    linhas = max(1, BYTES_JANELAS // max(1, janelas.shape[1] * t * t * pixels.itemsize))
+    for x in range(0, len(saida), linhas):
+        bloco = janelas[x:x + linhas].reshape(-1, janelas.shape[1], t * t)
+        saida[x:x + linhas] = np.partition(bloco, posicao, axis=2)[:, :, posicao]
+    return saida
+
+
+class Gradientes:
+    """
+        Gradientes de Sobel de uma matriz (altura, largura) ou (altura, largura, canais), nas
+        posicoes em que o kernel 3x3 cabe inteiro. Gx e Gy saem de uma unica passada pelos pixels,
+        com os kernels separados em suavizacao [1, 2, 1] e diferenca [-1, 0, 1]. Magnitude e
+        orientacao sao calculadas no primeiro pedido e reaproveitadas.
+
+        Gx usa [[-1, 0, 1], [-2, 0, 2], [-1, 0, 1]] e Gy [[1, 2, 1], [0, 0, 0], [-1, -2, -1]].
+    """
+    def __init__(self, pixels: np.ndarray):
+        pixels = np.asarray(pixels, dtype=np.int32)
+        diferenca = pixels[:, 2:] - pixels[:, :-2]
+        suavizado = pixels[:, :-2] + 2 * pixels[:, 1:-1] + pixels[:, 2:]
+
+        self.__gx = diferenca[:-2] + 2 * diferenca[1:-1] + diferenca[2:]
+        self.__gy = suavizado[:-2] - suavizado[2:]
+        self.__magnitude = None
+        self.__orientacao = None
+
+    def get_gx(self) -> np.ndarray:
+        return self.__gx
+
+    def get_gy(self) -> np.ndarray:
+        return self.__gy
+
+    def get_magnitude(self) -> np.ndarray:
+        if self.__magnitude is None:
+            gx = self.__gx.astype(np.float64)
+            gy = self.__gy.astype(np.float64)
+            self.__magnitude = np.sqrt(gx * gx + gy * gy)
+        return self.__magnitude
+
+    def get_orientacao(self) -> np.ndarray:
+        """
+        Direcao do gradiente em radianos, de -pi a pi, com x nas colunas e y nas linhas.
+        """
+        if self.__orientacao is None:
+            self.__orientacao = np.arctan2(self.__gy, self.__gx)
+        return self.__orientacao
+
+    def get_bordas(self, limiar: int, maxval: int) -> np.ndarray:
+        """
+        Magnitude truncada onde passa do limiar e 0 no resto, saturada em 0..maxval.
+        """
+        magnitude = self.get_magnitude()
+        return Imagem.saturar(np.where(magnitude > limiar, np.trunc(magnitude), 0), maxval)
+
+
+def aplicar_sobel(pixels: np.ndarray, limiar: int, maxval: int) -> np.ndarray:
+    """
+    Bordas de Sobel nas posicoes em que o kernel cabe inteiro na imagem (ver Gradientes).
+    Retorna a matriz 1 pixel menor de cada lado.
+    """
+    return Gradientes(pixels).get_bordas(limiar, maxval)
+
+
+def get_palavras(imagem: Imagem) -> np.ndarray:
+    """
+    Pixels de uma imagem binaria em palavras de 64 bits: uma linha da imagem por linha da matriz,
+    com a coluna 0 no bit mais significativo da primeira palavra.
+    """
+    bits = imagem.get_pixels_empacotados()
+    altura, bytes_linha = bits.shape
+    dados = np.zeros((altura, ((bytes_linha + 7) // 8) * 8), dtype=np.uint8)
+    dados[:, :bytes_linha] = bits
+    return dados.view('>u8').astype(np.uint64)
+
+
+def set_palavras(imagem: Imagem, palavras: np.ndarray):
+    bytes_linha = (imagem.get_largura() + 7) // 8
+    dados = palavras.astype('>u8').view(np.uint8)
+    imagem.set_pixels_empacotados(np.ascontiguousarray(dados[:, :bytes_linha]))
+
+
+def get_mascara_palavras(largura: int, altura: int, palavras_linha: int, borda: int) -> np.ndarray:
+    """
+    Mascara com 1 nos pixels a pelo menos `borda` pixels das bordas da imagem.
+    """
+    colunas = np.zeros(palavras_linha * 64, dtype=bool)
+    colunas[borda:largura - borda] = True
+    mascara = np.zeros((altura, palavras_linha), dtype=np.uint64)
+    mascara[borda:altura - borda] = np.packbits(colunas).view('>u8').astype(np.uint64)
+    return mascara
+
+
+def deslocar_palavras(palavras: np.ndarray, dx: int, dy: int) -> np.ndarray:
+    """
+    Desloca os pixels dx linhas para baixo e dy colunas para a direita (ou para cima e para a
+    esquerda, se negativos). O que sai da imagem e descartado e o que entra e 0.
+    """
+    altura, n = palavras.shape
+    if abs(dx) >= altura:
+        return np.zeros_like(palavras)
+
+    linhas = np.zeros_like(palavras)
+    if dx >= 0:
+        linhas[dx:] = palavras[:altura - dx]
     else:
-        if params is not None:
-            return np.array([
-                func(p, params) for p in imagem.get_pixels()
-            ])
-        else:
-            return np.array([
-                func(p) for p in imagem.get_pixels()
-            ])
+        linhas[:altura + dx] = palavras[-dx:]
+    if dy == 0:
+        return linhas
+
+    # Colunas: q palavras inteiras e r bits, levando o que transborda para a palavra vizinha
+    q, r = divmod(abs(dy), 64)
+    resultado = np.zeros_like(palavras)
+    if q >= n:
+        return resultado
+    if dy > 0:
+        resultado[:, q:] = linhas[:, :n - q] >> r
+        if r != 0:
+            resultado[:, q + 1:] |= linhas[:, :n - q - 1] << (64 - r)
+    else:
+        resultado[:, :n - q] = linhas[:, q:] << r
+        if r != 0:
+            resultado[:, :n - q - 1] |= linhas[:, q + 1:] >> (64 - r)
+    return resultado
+
+
+def dilatar_palavras(palavras: np.ndarray, elemento) -> np.ndarray:
+    """
+    Uniao de `palavras` deslocado para cada 1 do elemento estruturante, relativo ao seu centro.
+    """
+    centro = int((len(elemento) - 1) / 2)
+    resultado = np.zeros_like(palavras)
+    for x in range(len(elemento)):
+        for y in range(len(elemento[x])):
+            if elemento[x][y] == 1:
+                resultado |= deslocar_palavras(palavras, x - centro, y - centro)
+    return resultado
 
 
 class Processamento:
@@ -82,13 +442,53 @@ class Processamento:
     def processar(self, imagem: Imagem, params=None) -> Imagem:
         pass
 
+    def processar_tile(self, imagem: Imagem, tile: np.ndarray, params=None):
+        """
+        Altera no lugar um tile de `imagem` (ver Imagem.iterar_tiles). Apenas para processamentos
+        em que cada pixel so depende dele mesmo, que podem usar processar_tiles.
+        """
+        pass
+
     def processar_clone(self, imagem: Imagem, params=None) -> Imagem:
         clone = imagem.clonar()
         self.processar(clone, params)
         return clone
 
 
-class ProcessamentoNegativo(Processamento):
+class ProcessamentoPontual(Processamento):
+    """
+        Base dos processamentos em que o novo valor de cada amostra so depende dela mesma. As
+        subclasses implementam calcular_tabela, vetorizado, e o resultado para cada amostra e
+        lido de uma tabela com uma unica indexacao por tile. O canal alfa (PAM) e mantido.
+    """
+    def calcular_tabela(self, amostras: np.ndarray, maxval: int, params=None) -> np.ndarray:
+        """
+        :param amostras: todas as amostras possiveis, 0..maxval
+        :return: novo valor de cada amostra; saturado depois em 0..maxval
+        """
+        pass
+
+    def get_tabela(self, maxval: int, params=None) -> np.ndarray:
+        return get_tabela_pontual(self, maxval, params)
+
+    def get_binarizar(self) -> bool:
+        """
+        Indica se a tabela leva as amostras a 0 ou 1 e o resultado e uma imagem PBM (veja
+        binarizar). Num ProcessamentoPontualFundido, so a ultima etapa pode binarizar.
+        """
+        return False
+
+    def processar(self, imagem: Imagem, params=None) -> Imagem:
+        return processar_tiles(imagem, self, params)
+
+    def processar_tile(self, imagem: Imagem, tile: np.ndarray, params=None):
+        tabela = self.get_tabela(imagem.get_maxval(), params)
+        cor = tile[..., :-1] if tile.ndim > 2 and imagem.get_alfa() else tile
+        # Amostras acima de maxval (possiveis em arquivos mapeados) usam a ultima entrada
+        cor[...] = np.take(tabela, cor, mode='clip')
+
+
+class ProcessamentoNegativo(ProcessamentoPontual):
     def get_nome(self) -> str:
         return 'Negativo'
 
@@ -101,14 +501,11 @@ class ProcessamentoNegativo(Processamento):
     def get_permitir_nao_binarias(self) -> bool:
         return True
 
-    def processar(self, imagem: Imagem, params=None) -> Imagem:
-        maxval = imagem.get_maxval()
-        imagem.set_pixels(processar_independente(imagem,
-                                                 lambda p: maxval - p))
-        return imagem
+    def calcular_tabela(self, amostras: np.ndarray, maxval: int, params=None) -> np.ndarray:
+        return maxval - amostras
 
 
-class ProcessamentoCorrecaoGama(Processamento):
+class ProcessamentoCorrecaoGama(ProcessamentoPontual):
     def get_nome(self) -> str:
         return 'Correcao Gama'
 
@@ -139,14 +536,11 @@ class ProcessamentoCorrecaoGama(Processamento):
             ('1.90', 1.90)
         ]
 
-    def processar(self, imagem: Imagem, params=None) -> Imagem:
-        maxval = imagem.get_maxval()
-        imagem.set_pixels(processar_independente(imagem,
-                                                 lambda p: int(((p / maxval) ** params) * maxval)))
-        return imagem
+    def calcular_tabela(self, amostras: np.ndarray, maxval: int, params=None) -> np.ndarray:
+        return np.trunc(((amostras / maxval) ** params) * maxval)
 
 
-class ProcessamentoTransformacaoLogaritmica(Processamento):
+class ProcessamentoTransformacaoLogaritmica(ProcessamentoPontual):
     def get_nome(self) -> str:
         return 'Transformacao Logaritmica'
 
@@ -159,14 +553,95 @@ class ProcessamentoTransformacaoLogaritmica(Processamento):
     def get_permitir_nao_binarias(self) -> bool:
         return True
 
+    def calcular_tabela(self, amostras: np.ndarray, maxval: int, params=None) -> np.ndarray:
+        return np.trunc(np.log(1 + (amostras / maxval)) * maxval)
+
+
+class ProcessamentoPontualFundido(ProcessamentoPontual):
+    """
+        Sequencia de processamentos pontuais aplicada numa unica passada pelos pixels: as tabelas
+        das etapas sao compostas numa so. O resultado e o mesmo de aplicar as etapas em ordem.
+        Terminando num limiar (Preto e Branco), a tabela composta ja da os bits da imagem PBM.
+
+        Exemplo:
+            ajuste = ProcessamentoPontualFundido([ProcessamentoNegativo(),
+                                                  (ProcessamentoCorrecaoGama(), 0.5),
+                                                  (ProcessamentoPretoBranco(), 127)])
+            ajuste.processar(imagem)
+    """
+    def __init__(self, etapas: list):
+        """
+        :param etapas: ProcessamentoPontual ou tuplas (ProcessamentoPontual, params)
+        """
+        self.__etapas = tuple(e if type(e) == tuple else (e, None) for e in etapas)
+        for processamento, params in self.__etapas:
+            if not isinstance(processamento, ProcessamentoPontual):
+                raise Exception('%s não é um processamento pontual.' % processamento.get_nome())
+        for processamento, params in self.__etapas[:-1]:
+            if processamento.get_binarizar():
+                raise Exception('%s só pode ser a última etapa.' % processamento.get_nome())
+
+    def get_etapas(self) -> tuple:
+        return self.__etapas
+
+    def get_nome(self) -> str:
+        return ' + '.join(processamento.get_nome() for processamento, params in self.__etapas)
+
+    def get_descricao(self) -> str:
+        return ''
+
+    def get_permitir_binarias(self) -> bool:
+        return all(processamento.get_permitir_binarias() for processamento, params in self.__etapas)
+
+    def get_permitir_nao_binarias(self) -> bool:
+        return all(processamento.get_permitir_nao_binarias() for processamento, params in self.__etapas)
+
+    def get_binarizar(self) -> bool:
+        return len(self.__etapas) > 0 and self.__etapas[-1][0].get_binarizar()
+
+    def calcular_tabela(self, amostras: np.ndarray, maxval: int, params=None) -> np.ndarray:
+        # As tabelas estao em 0..maxval, entao cada uma pode indexar a seguinte
+        for processamento, params_etapa in self.__etapas:
+            amostras = processamento.get_tabela(maxval, params_etapa)[amostras]
+        return amostras
+
     def processar(self, imagem: Imagem, params=None) -> Imagem:
-        maxval = imagem.get_maxval()
-        imagem.set_pixels(processar_independente(imagem,
-                                                 lambda p: int((math.log(1 + (p / maxval))) * maxval)))
-        return imagem
+        if not self.get_binarizar():
+            return ProcessamentoPontual.processar(self, imagem, params)
+        if imagem.get_canais() == 1:
+            return binarizar(imagem, self.get_tabela(imagem.get_maxval(), params))
+
+        # Em imagens coloridas a conversao para cinza fica entre as etapas anteriores e a ultima
+        ultima, params_ultima = self.__etapas[-1]
+        if len(self.__etapas) > 1:
+            imagem = ProcessamentoPontualFundido(self.__etapas[:-1]).processar(imagem)
+        return ultima.processar(imagem, params_ultima)
 
 
 class ProcessamentoFiltroBase(Processamento):
+    def __init__(self, borda: str or None = None, processos: int = 1):
+        """
+        :param borda: um dos BORDAS; ver filtrar
+        :param processos: processos para filtrar os tiles de cada faixa, quando ha borda
+        """
+        self.__borda = None
+        self.__processos = processos
+        self.set_borda(borda)
+
+    def get_borda(self) -> str or None:
+        return self.__borda
+
+    def set_borda(self, borda: str or None):
+        if borda not in BORDAS:
+            raise Exception('Borda inválida: ' + str(borda))
+        self.__borda = borda
+
+    def get_processos(self) -> int:
+        return self.__processos
+
+    def set_processos(self, processos: int):
+        self.__processos = processos
+
     def get_kernel(self, params=None):
         pass
 
@@ -180,36 +655,8 @@ class ProcessamentoFiltroBase(Processamento):
         kernel = self.get_kernel(params)
         ks = int((len(kernel) - 1) / 2)
 
-        largura = imagem.get_largura()
-        altura = imagem.get_altura()
-        novos_pixels = []
-
-        if imagem.get_tipo() == 'P3':
-            pixels = np.reshape(imagem.get_pixels(), (altura, largura, 3))
-            for x in range(ks, altura - ks):
-                for y in range(ks, largura - ks):
-                    sum = [0, 0, 0]
-                    for k in range(3):
-                        for ki in range(len(kernel)):
-                            for kj in range(len(kernel[1])):
-                                sum[k] = sum[k] + (pixels[x - ks + ki][y - ks + kj][k] * kernel[ki][kj])
-                        sum[k] = int(sum[k])
-                    novos_pixels.append(np.array(sum))
-        else:
-            pixels = np.reshape(imagem.get_pixels(), (altura, largura))
-            for x in range(ks, altura - ks):
-                for y in range(ks, largura - ks):
-                    sum = 0
-                    for ki in range(len(kernel)):
-                        for kj in range(len(kernel[1])):
-                            sum = sum + (pixels[x - ks + ki][y - ks + kj] * kernel[ki][kj])
-                    sum = int(sum)
-                    novos_pixels.append(sum)
-
-        imagem.set_pixels(np.array(novos_pixels))
-        imagem.set_largura(largura - (2 * ks))
-        imagem.set_altura(altura - (2 * ks))
-        return imagem
+        funcao = functools.partial(convoluir, kernel=kernel, maxval=imagem.get_maxval())
+        return filtrar(imagem, funcao, ks, self.get_borda(), self.get_processos())
 
 
 class ProcessamentoFiltroSharpen(ProcessamentoFiltroBase):
@@ -238,6 +685,71 @@ class ProcessamentoFiltroMediana(ProcessamentoFiltroBase):
         return kernel
 
 
+class ProcessamentoFiltroMedia(ProcessamentoFiltroBase):
+    """
+        Media (box blur) em janelas de 3x3 ate 101x101, com custo por pixel constante: as somas
+        das janelas vem da imagem integral.
+    """
+    def get_nome(self) -> str:
+        return 'Filtro Media'
+
+    def get_descricao(self) -> str:
+        return ''
+
+    def get_default_params(self):
+        return [
+            ('3x3', 3),
+            ('5x5', 5),
+            ('15x15', 15),
+            ('31x31', 31),
+            ('51x51', 51),
+            ('101x101', 101)
+        ]
+
+    def processar(self, imagem: Imagem, params=None) -> Imagem:
+        tamanho = 3 if params is None else params
+        if tamanho < 3 or tamanho > 101 or tamanho % 2 == 0:
+            raise Exception('Tamanho de janela inválido: %d.' % tamanho)
+
+        if self.get_borda() is None and not imagem.get_em_tiles():
+            # Sem borda a imagem integral da propria imagem, mantida em cache, serve a qualquer tamanho
+            media = imagem.get_media_local(tamanho)
+            imagem.set_matriz(Imagem.saturar(media, imagem.get_maxval()))
+            return imagem
+
+        funcao = functools.partial(media_caixa, tamanho=tamanho, maxval=imagem.get_maxval())
+        return filtrar(imagem, funcao, tamanho // 2, self.get_borda(), self.get_processos())
+
+
+class ProcessamentoMediana(ProcessamentoFiltroBase):
+    """
+        Mediana de verdade (o Filtro Mediana e uma media 3x3), contra ruido sal e pimenta. Cada
+        canal e filtrado separadamente.
+    """
+    def get_nome(self) -> str:
+        return 'Mediana'
+
+    def get_descricao(self) -> str:
+        return 'Mediana de cada janela, contra ruído sal e pimenta'
+
+    def get_default_params(self):
+        return [
+            ('3x3', 3),
+            ('5x5', 5),
+            ('7x7', 7),
+            ('15x15', 15),
+            ('31x31', 31)
+        ]
+
+    def processar(self, imagem: Imagem, params=None) -> Imagem:
+        tamanho = 3 if params is None else params
+        if tamanho < 3 or tamanho % 2 == 0:
+            raise Exception('Tamanho de janela inválido: %d.' % tamanho)
+
+        funcao = functools.partial(mediana, tamanho=tamanho)
+        return filtrar(imagem, funcao, tamanho // 2, self.get_borda(), self.get_processos())
+
+
 class ProcessamentoFiltroGaussiana(ProcessamentoFiltroBase):
     def get_nome(self) -> str:
         return 'Filtro Gaussiana'
@@ -270,7 +782,7 @@ class ProcessamentoFiltroGaussiana(ProcessamentoFiltroBase):
         return kernel
 
 
-class ProcessamentoFiltroSobel(Processamento):
+class ProcessamentoFiltroSobel(ProcessamentoFiltroBase):
     def get_nome(self) -> str:
         return 'Filtro Sobel'
 
@@ -294,51 +806,18 @@ class ProcessamentoFiltroSobel(Processamento):
         if params is None:
             params = 64
 
-        kernelx = [[-1, 0, 1], [2, 0, -2], [1, 0, -1]]
-        kernelx = np.asarray(kernelx)
-        kernely = [[1, 2, 1], [0, 0, 0], [-1, -2, -1]]
-        kernely = np.asarray(kernely)
-        ks = int((len(kernelx)-1)/2)
-
-        largura = imagem.get_largura()
-        altura = imagem.get_altura()
-        novos_pixels = []
-
-        if imagem.get_tipo() == 'P3':
-            pixels = np.reshape(imagem.get_pixels(), (altura, largura, 3))
-            for x in range(ks, largura - ks):
-                for y in range(ks, altura - ks):
-                    sum = [0, 0, 0]
-                    for k in range(3):
-                        sumx = 0
-                        sumy = 0
-                        for ki in range(len(kernelx)):
-                            for kj in range(len(kernelx[1])):
-                                sumx = sumx + (pixels[x - ks + ki][y - ks + kj][k] * kernelx[ki][kj])
-                                sumy = sumy + (pixels[x - ks + ki][y - ks + kj][k] * kernely[ki][kj])
-                        sumxy = math.sqrt((sumx ** 2) + (sumy ** 2))
-                        sum[k] = max(sumxy, params)
-                        sum[k] = int(sum[k]) if sum[k] != params else 0
-                    novos_pixels.append(sum)
-        else:
-            pixels = np.reshape(imagem.get_pixels(), (altura, largura))
-            for x in range(ks, largura - ks):
-                for y in range(ks, altura - ks):
-                    sumx = 0
-                    sumy = 0
-                    for ki in range(len(kernelx)):
-                        for kj in range(len(kernelx[1])):
-                            sumx = sumx + (pixels[x - ks + ki][y - ks + kj] * kernelx[ki][kj])
-                            sumy = sumy + (pixels[x - ks + ki][y - ks + kj] * kernely[ki][kj])
-                    sumxy = math.sqrt((sumx ** 2) + (sumy ** 2))
-                    sum = max(sumxy, params)
-                    sum = int(sum) if sum != params else 0
-                    novos_pixels.append(sum)
-
-        imagem.set_pixels(np.array(novos_pixels))
-        imagem.set_largura(largura - 2 * ks)
-        imagem.set_altura(altura - 2 * ks)
-        return imagem
+        funcao = functools.partial(aplicar_sobel, limiar=params, maxval=imagem.get_maxval())
+        return filtrar(imagem, funcao, 1, self.get_borda(), self.get_processos())
+
+    def get_gradientes(self, imagem: Imagem) -> Gradientes:
+        """
+        Gradientes da imagem inteira, para reaproveitar em outros operadores de borda. Com borda
+        eles tem o tamanho da imagem; sem ela, 1 pixel a menos de cada lado.
+        """
+        if self.get_borda() is None:
+            return Gradientes(imagem.get_matriz())
+        return Gradientes(ler_com_borda(imagem, -1, -1, imagem.get_altura() + 2, imagem.get_largura() + 2,
+                                        self.get_borda()))
 
 
 class ProcessamentoFiltroDeteccaoBorda(ProcessamentoFiltroBase):
@@ -381,14 +860,26 @@ class ProcessamentoEscalaCinza(Processamento):
     def get_permitir_nao_binarias(self) -> bool:
         return True
 
+    def get_default_params(self):
+        return [
+            ('Média', 'media'),
+            ('BT.601', 'bt601'),
+            ('BT.709', 'bt709')
+        ]
+
     def processar(self, imagem: Imagem, params=None) -> Imagem:
-        if imagem.get_tipo() == 'P2':
+        if params is None:
+            params = 'media'
+        if imagem.get_tipo_plain() == 'P2':
             return imagem
 
-        return converter_pgm(imagem)
+        return converter_pgm(imagem, params)
 
 
-class ProcessamentoPretoBranco(Processamento):
+class ProcessamentoPretoBranco(ProcessamentoPontual):
+    """
+        Limiar: amostras de cinza acima de params viram 1 e as demais 0, numa imagem PBM.
+    """
     def get_nome(self) -> str:
         return 'Preto e Branco'
 
@@ -412,21 +903,16 @@ class ProcessamentoPretoBranco(Processamento):
             ('90%', int(255 * .90)),
         ]
 
-    def processar(self, imagem: Imagem, params=None) -> Imagem:
+    def get_binarizar(self) -> bool:
+        return True
+
+    def calcular_tabela(self, amostras: np.ndarray, maxval: int, params=None) -> np.ndarray:
         if params is None:
             params = int(255 * .50)
-        if imagem.get_tipo() == 'P3':
-            imagem = self.get_processamentos().get_escala_cinza().processar(imagem)
+        return np.where(amostras > params, 1, 0)
 
-        pixels = imagem.get_pixels()
-        for i in range(len(pixels)):
-            p = pixels[i]
-            if p > params:
-                pixels[i] = 1
-            else:
-                pixels[i] = 0
-
-        return converter_pbm(imagem)
+    def processar(self, imagem: Imagem, params=None) -> Imagem:
+        return binarizar(imagem, self.get_tabela(imagem.get_maxval(), params))
 
 
 class ProcessamentoSepararCamada(Processamento):
@@ -450,7 +936,7 @@ class ProcessamentoSepararCamada(Processamento):
         ]
 
     def processar(self, imagem: Imagem, params=None) -> Imagem:
-        if imagem.get_tipo() != 'P3':
+        if imagem.get_tipo_plain() != 'P3':
             imagem = converter_ppm(imagem)
 
         # Azul
@@ -463,7 +949,7 @@ class ProcessamentoSepararCamada(Processamento):
         else:
             indice = 0
 
-        pixels = imagem.get_pixels()
+        pixels = imagem.get_pixels(escrita=True)
         for i in range(len(pixels)):
             p = pixels[i]
             novo_pixel = np.zeros(len(p))
@@ -511,18 +997,12 @@ class ProcessamentoErosao(Processamento):
         estruturante = self.get_estruturante(params)
         pixel = int((len(estruturante) - 1) / 2)
 
-        pixels = imagem.get_pixels()
-        pixels = np.reshape(pixels, (imagem.get_altura(), imagem.get_largura()))
-        novos_pixels = pixels.copy()
-        for i in range(pixel, imagem.get_altura() - pixel):
-            for j in range(pixel, imagem.get_largura() - pixel):
-                for x in range(len(estruturante)):
-                    for y in range(len(estruturante[1])):
-                        if pixels[i][j] == 0 and estruturante[x][y] == 1:
-                            novos_pixels[i - pixel + x][j - pixel + y] = 0
-
-        novos_pixels = np.reshape(novos_pixels, len(imagem.get_pixels()))
-        imagem.set_pixels(novos_pixels)
+        # Cada 0 a pelo menos `pixel` pixels da borda apaga os pixels cobertos pelo estruturante
+        palavras = get_palavras(imagem)
+        mascara = get_mascara_palavras(imagem.get_largura(), imagem.get_altura(), palavras.shape[1], pixel)
+        apagados = dilatar_palavras(~palavras & mascara, estruturante)
+
+        set_palavras(imagem, palavras & ~apagados)
         return imagem
 
 
@@ -566,19 +1046,12 @@ class ProcessamentoDilatacao(Processamento):
         elemento = self.get_elemento(params)
         es = int((len(elemento) - 1) / 2)
 
-        pixels = imagem.get_pixels()
-        pixels = np.reshape(pixels, (imagem.get_altura(), imagem.get_largura()))
-        novos_pixels = pixels.copy()
-        for px in range(es, imagem.get_altura() - es):
-            for py in range(es, imagem.get_largura() - es):
-                if pixels[px][py] == 1:
-                    for ex in range(len(elemento)):
-                        for ey in range(len(elemento[1])):
-                            if elemento[ex][ey] == 1:
-                                novos_pixels[px - es + ex][py - es + ey] = 1
-
-        novos_pixels = np.reshape(novos_pixels, len(imagem.get_pixels()))
-        imagem.set_pixels(novos_pixels)
+        # Cada 1 a pelo menos `es` pixels da borda acende os pixels cobertos pelo elemento
+        palavras = get_palavras(imagem)
+        mascara = get_mascara_palavras(imagem.get_largura(), imagem.get_altura(), palavras.shape[1], es)
+        acesos = dilatar_palavras(palavras & mascara, elemento)
+
+        set_palavras(imagem, palavras | acesos)
         return imagem
 
 
@@ -661,11 +1134,10 @@ class ProcessamentoDeteccaoBordaErosao(Processamento):
         imagem_original = imagem
         imagem_erosao = self.get_processamentos().get_erosao().processar(imagem.clonar(), params)
 
-        pixels_original = imagem_original.get_pixels()
-        pixels_erosao = imagem_erosao.get_pixels()
-
-        for i in range(len(pixels_original)):
-            pixels_original[i] = (pixels_original[i] - pixels_erosao[i]) % 2
+        # Para pixels binarios, (a - b) % 2 equivale a um ou-exclusivo, feito direto nos bytes empacotados
+        bits_original = imagem_original.get_pixels_empacotados()
+        bits_erosao = imagem_erosao.get_pixels_empacotados()
+        imagem.set_pixels_empacotados(np.bitwise_xor(bits_original, bits_erosao))
         return imagem
 
 
@@ -694,11 +1166,10 @@ class ProcessamentoDeteccaoBordaDilatacao(Processamento):
         imagem_original = imagem
         imagem_dilatacao = self.get_processamentos().get_dilatacao().processar(imagem.clonar(), params)
 
-        pixels_original = imagem_original.get_pixels()
-        pixels_dilatacao = imagem_dilatacao.get_pixels()
-
-        for i in range(len(pixels_original)):
-            pixels_original[i] = (pixels_original[i] - pixels_dilatacao[i]) % 2
+        # Para pixels binarios, (a - b) % 2 equivale a um ou-exclusivo, feito direto nos bytes empacotados
+        bits_original = imagem_original.get_pixels_empacotados()
+        bits_dilatacao = imagem_dilatacao.get_pixels_empacotados()
+        imagem.set_pixels_empacotados(np.bitwise_xor(bits_original, bits_dilatacao))
         return imagem
 
 
@@ -727,31 +1198,9 @@ class ProcessamentoRodarImagem(Processamento):
             params = 90
 
         indice = int((params % 360) / 90)
-        pixels = imagem.get_pixels()
-        novos_pixels = []
-
-        if indice % 2 == 1:
-            aux = imagem.get_largura()
-            imagem.set_largura(imagem.get_altura())
-            imagem.set_altura(aux)
-
-        largura = imagem.get_largura()
-        altura = imagem.get_altura()
-
-        if indice == 1:  # 90
-            for j in range(0, altura):
-                for i in range(largura - 1, -1, -1):
-                    novos_pixels.append(pixels[imagem.get_pixel_index(i, j)])
-        elif indice == 2:  # 180
-            for i in range(largura - 1, -1, -1):
-                for j in range(altura - 1, -1, -1):
-                    novos_pixels.append(pixels[imagem.get_pixel_index(i, j)])
-        elif indice == 3:  # 270
-            for j in range(altura - 1, -1, -1):
-                for i in range(0, largura):
-                    novos_pixels.append(pixels[imagem.get_pixel_index(i, j)])
-
-        imagem.set_pixels(np.array(novos_pixels))
+
+        # np.rot90 gira no sentido anti-horario; 90 aqui e no sentido horario
+        imagem.set_matriz(np.rot90(imagem.get_matriz(), -indice))
         return imagem
 
 
@@ -779,22 +1228,12 @@ class ProcessamentoEspelharImagem(Processamento):
             params = 0
 
         indice = params
-        pixels = imagem.get_pixels()
-        novos_pixels = []
-
-        largura = imagem.get_largura()
-        altura = imagem.get_altura()
+        matriz = imagem.get_matriz()
 
         if indice == 0:  # Vertical
-            for i in range(largura - 1, -1, -1):
-                for j in range(0, altura):
-                    novos_pixels.append(pixels[imagem.get_pixel_index(i, j)])
+            imagem.set_matriz(matriz[::-1])
         else:  # Horizontal
-            for i in range(0, largura):
-                for j in range(altura - 1, -1, -1):
-                    novos_pixels.append(pixels[imagem.get_pixel_index(i, j)])
-
-        imagem.set_pixels(np.array(novos_pixels))
+            imagem.set_matriz(matriz[:, ::-1])
         return imagem
 
 
@@ -820,8 +1259,8 @@ class ProcessamentoAndyWarhol(Processamento):
     def processar(self, imagem: Imagem, params=None) -> Imagem:
         if params is None:
             params = 0
-        if imagem.get_tipo() == 'P3':
-            imagem = self.get_processamentos().get_escala_cinza().processar(imagem)
+        if imagem.get_canais() > 1:
+            imagem = converter_pgm(imagem)
 
         # Cores pre-definidas
         cores = [[[ 45, 165, 195], [149, 248,  63], [209, 206,  54], [ 95,  15, 191]],
@@ -835,51 +1274,26 @@ class ProcessamentoAndyWarhol(Processamento):
         for i in range(len(cores)):
             pixels_coloridos.append(self._processar_parcial(imagem, cores[i],
                                                             params == 1 and i >= len(cores) / 2))
-        # Montar imagem
-        meia_largura = imagem.get_largura()
-        meia_altura = imagem.get_altura()
-        largura = imagem.get_largura() * 2
-        altura = imagem.get_altura() * 2
-
-        novos_pixels = []
-        for i in range(largura):
-            for j in range(altura):
-                indice_pixels_coloridos = int(j / meia_largura) * 2 + int(i / meia_largura)
-                x = i % meia_largura
-                y = j % meia_altura
-                indice = x * meia_largura + y
-
-                novos_pixels.append(pixels_coloridos[indice_pixels_coloridos][indice])
-
-        imagem.set_largura(largura)
-        imagem.set_altura(altura)
-        imagem.set_tipo('P3')
-        imagem.set_pixels(np.array(novos_pixels))
+        # Montar imagem: as duas primeiras na coluna da esquerda, as duas ultimas na da direita
+        esquerda = np.concatenate(pixels_coloridos[:2], axis=0)
+        direita = np.concatenate(pixels_coloridos[2:], axis=0)
+
+        imagem.set_tipo_plain('P3')
+        imagem.set_matriz(np.concatenate((esquerda, direita), axis=1))
         return imagem
 
     def _processar_parcial(self, imagem, cores, espelhar):
-        largura = imagem.get_largura()
         maxval = imagem.get_maxval()
-        altura = imagem.get_altura()
-        pixels = imagem.get_pixels().copy()
+        matriz = imagem.get_matriz()
+        if espelhar:
+            matriz = matriz[:, ::-1]
 
         canais = len(cores)
         por_canal = maxval / canais
 
-        novos_pixels = []
-        if not espelhar:  # Nao espelhar
-            for i in range(len(pixels)):
-                canal_pixel = int(pixels[i] / por_canal)
-                novos_pixels.append(np.array(cores[canal_pixel]))
-        else:  # Espelhar
-            for i in range(0, largura):
-                for j in range(altura - 1, -1, -1):
-                    indice = imagem.get_pixel_index(i, j)
-                    canal_pixel = int(pixels[indice] / por_canal)
-                    novos_pixels.append(np.array(cores[canal_pixel]))
-            pixels = np.array(novos_pixels)
-
-        return novos_pixels
+        # O maxval cairia num canal a mais: fica no ultimo
+        canal_pixel = np.minimum((matriz / por_canal).astype(int), canais - 1)
+        return np.asarray(cores)[canal_pixel]
 
 
 class Processamentos:
@@ -891,6 +1305,8 @@ class Processamentos:
         self.__transformacao_logaritmica = None
         self.__filtro_sharpen = None
         self.__filtro_mediana = None
+        self.__filtro_media = None
+        self.__mediana = None
         self.__filtro_gaussiana = None
         self.__filtro_sobel = None
         self.__filtro_deteccao_borda = None
@@ -912,6 +1328,8 @@ class Processamentos:
             self.get_transformacao_logaritmica,
             self.get_filtro_sharpen,
             self.get_filtro_mediana,
+            self.get_filtro_media,
+            self.get_mediana,
             self.get_filtro_gaussiana,
             self.get_filtro_sobel,
             self.get_filtro_deteccao_borda,
@@ -959,6 +1377,16 @@ class Processamentos:
             self.__filtro_mediana = ProcessamentoFiltroMediana()
         return self.__filtro_mediana
 
+    def get_filtro_media(self):
+        if self.__filtro_media is None:
+            self.__filtro_media = ProcessamentoFiltroMedia()
+        return self.__filtro_media
+
+    def get_mediana(self):
+        if self.__mediana is None:
+            self.__mediana = ProcessamentoMediana()
+        return self.__mediana
+
     def get_filtro_gaussiana(self):
         if self.__filtro_gaussiana is None:
             self.__filtro_gaussiana = ProcessamentoFiltroGaussiana()